@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Benchmark: per-frame cost of the mega2560 driver loop
+
+Drives Mega2560Driver.step() against a simulated port that always has input frames waiting, so every step runs
+the full path: output keepalive check, read, reassembly, decode, debounce, snapshot, hal sync (on HalShim).
+
+Usage:
+    python benchmarks/bench_driver_step.py [--protocol framed] [--steps 100000] [--frames-per-read 1]
+"""
+from __future__ import print_function
+import os
+import sys
+import random
+import logging
+import argparse
+import time
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, join(dirname(abspath(__file__)), '..'))
+
+from mega2560_protocol import PROTOCOL_LEGACY, PROTOCOL_FRAMED, encode_frame, encode_legacy_input
+import mega2560_hal_io_pins
+
+
+class SimulatedPort(object):
+    """
+    Always readable (a pipe with a byte that is never drained), every read returns the next chunk of frames.
+    The driver drops the first frame while it syncs to the stream, after that the chunks repeat seamlessly.
+    """
+    baudrate = 115200
+    port = 'simulated'
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._idx = 0
+        self._read_fd, self._write_fd = os.pipe()
+        os.write(self._write_fd, b'\0')
+        self.timeout = 0
+        self.in_waiting = len(chunks[0])
+        self.bytes_written = 0
+
+    def fileno(self):
+        return self._read_fd
+
+    def read(self, size=1):
+        chunk = self._chunks[self._idx]
+        self._idx = (self._idx + 1) % len(self._chunks)
+        self.in_waiting = len(self._chunks[self._idx])
+        return chunk
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return len(data)
+
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--protocol', choices=(PROTOCOL_LEGACY, PROTOCOL_FRAMED), default=PROTOCOL_FRAMED)
+    parser.add_argument('--inputs', type=int, default=34)
+    parser.add_argument('--outputs', type=int, default=18)
+    parser.add_argument('--steps', type=int, default=100000)
+    parser.add_argument('--frames-per-read', type=int, default=1)
+    parser.add_argument('--toggle', type=float, default=0.1, help='probability an input changes between frames')
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.ERROR)
+    for name in ('mega2560', 'bench'):
+        logging.getLogger(name).setLevel(logging.ERROR)
+
+    rand = random.Random(4024)
+    mask = 0
+    frames = []
+    for _ in range(1000):
+        if rand.random() < args.toggle:
+            mask ^= 1 << rand.randrange(args.inputs)
+        if args.protocol == PROTOCOL_FRAMED:
+            frames.append(bytes(encode_frame(mask, args.inputs)))
+        else:
+            frames.append(bytes(encode_legacy_input(mask, args.inputs)))
+    chunks = [b''.join(frames[idx:idx + args.frames_per_read])
+              for idx in range(0, len(frames), args.frames_per_read)]
+
+    conf = {'LOG_LEVEL': 'ERROR', 'DEVICES': [{'COMPONENT': 'bench', 'INPUT_COUNT': args.inputs,
+                                               'OUTPUT_COUNT': args.outputs}]}
+    driver = mega2560_hal_io_pins.Mega2560Driver().configure(conf)
+    port = SimulatedPort(chunks)
+    driver.connect({'bench': (port, args.protocol)})
+
+    device = driver.devices[0]
+    step = driver.step
+    start = time.time()
+    for _ in range(args.steps):
+        step()
+    elapsed = time.time() - start
+    port.close()
+
+    frames_decoded = device.stats.counters['frames-ok']
+    errors = device.stats.counters['frames-bad-checksum'] + device.stats.counters['frames-short']
+    print('{} protocol, {} inputs, {} frames per read'.format(args.protocol, args.inputs, args.frames_per_read))
+    print('{} steps in {:.2f}s, {:.2f} us/step'.format(args.steps, elapsed, elapsed / args.steps * 1e6))
+    print('{} frames ({} errors), {:.2f} us/frame, {:.0f} frames/s'.format(
+        frames_decoded, errors, elapsed / max(frames_decoded, 1) * 1e6, frames_decoded / elapsed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
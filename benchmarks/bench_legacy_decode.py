@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark: legacy (byte-per-pin) input validation
+
+Compares the original list comprehension checksum/decode path against
+mega2560_protocol.decode_legacy_input()
+
+Usage:
+    python benchmarks/bench_legacy_decode.py [raw-capture] [--count 34] [--repeat 5]
+
+`raw-capture` is a raw dump of the serial stream (for example `cat /dev/ttyACM0 > frames.bin`), when it isn't
+given a set of frames is generated with a fixed seed.
+"""
+from __future__ import print_function
+import sys
+import random
+import argparse
+import timeit
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, join(dirname(abspath(__file__)), '..'))
+
+from mega2560_protocol import LEGACY_DELIMITER, LEGACY_PREFIX, PIN_ON, PIN_OFF, CHECKSUM_ON, CHECKSUM_OFF, \
+    FrameBuffer, FrameError, decode_legacy_input, encode_legacy_input
+
+PIN_ON_CHAR = bytes(bytearray((PIN_ON,)))[0]  # str in python 2, int in python 3, same as iterating bytes
+PIN_OFF_CHAR = bytes(bytearray((PIN_OFF,)))[0]
+
+
+def comprehension_decode(input_msg, count):
+    """
+    The original decode path from mega2560_hal_io_pins.py, kept here as the baseline.
+    """
+    input_msg = bytes(input_msg)
+    if len(input_msg) < LEGACY_PREFIX + count:
+        return None
+    checksum = bytearray(input_msg[0:1])[0]
+    num_inputs = bytearray(input_msg[1:2])[0]
+    input_states = input_msg[LEGACY_PREFIX:]
+    if num_inputs != count:
+        return None
+
+    calc_pins_on = sum([1 if char_value == PIN_ON_CHAR else 0 for char_value in input_states])
+    calc_checksum = sum([CHECKSUM_ON if char_value == PIN_ON_CHAR else CHECKSUM_OFF for char_value in input_states])
+    if checksum != calc_checksum:
+        return None
+    if len(input_states) != count:
+        return None
+
+    input_mask = 0
+    for i in range(count):
+        state = input_states[i]
+        if state == PIN_ON_CHAR:
+            input_mask |= 1 << i
+    return input_mask, calc_pins_on, checksum
+
+
+def vectorized_decode(input_msg, count):
+    try:
+        return decode_legacy_input(input_msg, count)[:3]
+    except FrameError:
+        return None
+
+
+def generate_frames(count, frames, seed=4024):
+    rand = random.Random(seed)
+    out = []
+    for _ in range(frames):
+        mask = sum(1 << idx for idx in range(count) if rand.random() < 0.3)
+        out.append(encode_legacy_input(mask, count)[:-len(LEGACY_DELIMITER)])
+    return out
+
+
+def load_frames(path):
+    buff = FrameBuffer(LEGACY_DELIMITER)
+    with open(path, 'rb') as fp:
+        return buff.feed(fp.read())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture', nargs='?', help='raw serial capture, newline delimited legacy frames')
+    parser.add_argument('--count', type=int, default=34, help='configured INPUT_COUNT')
+    parser.add_argument('--frames', type=int, default=1000, help='frames to generate when no capture is given')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    frames = load_frames(args.capture) if args.capture else generate_frames(args.count, args.frames)
+    if not frames:
+        print('no frames to decode')
+        return 1
+
+    mismatches = sum(1 for frame in frames
+                     if comprehension_decode(frame, args.count) != vectorized_decode(frame, args.count))
+    if mismatches:
+        print('WARNING: {} frames decoded differently'.format(mismatches))
+
+    results = {}
+    for name, fn in (('comprehension', comprehension_decode), ('vectorized', vectorized_decode)):
+        def run():
+            for frame in frames:
+                fn(frame, args.count)
+        best = min(timeit.repeat(run, number=1, repeat=args.repeat))
+        results[name] = best
+        print('{:<14} {:>10.2f} us/frame {:>12.0f} frames/s'.format(name, best / len(frames) * 1e6,
+                                                                     len(frames) / best))
+
+    print('speedup: {:.1f}x over {} frames'.format(results['comprehension'] / results['vectorized'], len(frames)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Benchmark: pendant report decoding
+
+Replays a report corpus through decode_report() (what pendant_io.py runs per report) and through the dict based
+read_data(). The corpus is a capture recorded with pendant_capture.py, or a synthetic one: MPG spins, button
+presses and selector changes. Before timing, both decoders must agree on the corpus and on MPG-only reports
+mixed with every button code.
+
+Reports reports/s, per report latency percentiles and, over the first ALLOC_SAMPLE reports, the memory blocks a
+report leaves allocated (sys.getallocatedblocks() delta) and the memory it needs while it is decoded (tracemalloc
+peak bytes). Python 3.9 or newer.
+
+Usage:
+    python3 benchmarks/bench_pendant_decode.py [--corpus capture.bin] [--reports 200000]
+"""
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, join(dirname(abspath(__file__)), '..'))
+
+import pendant_io
+from pendant_io import PendantState, decode_report, read_data, AXS_MAP, SPD_MAP, BTN_MAP, AXS_BYTE, SPD_BYTE, \
+    BTN_BYTE, BTN2_BYTE, ENC_BYTE
+from pendant_capture import load_reports
+
+ALLOC_SAMPLE = 10000  # reports traced for the allocation measurement, tracing is slow
+
+
+def synthetic_corpus(count, seed=4024):
+    """mostly MPG reports, like a pendant being used to jog, with the odd button and selector change"""
+    rand = random.Random(seed)
+    axis = list(AXS_MAP)
+    speed = list(SPD_MAP)
+    buttons = [0] * 8 + list(BTN_MAP)
+    report = bytearray(8)
+    report[0] = 0x04
+    report[AXS_BYTE] = axis[1]
+    report[SPD_BYTE] = speed[0]
+    corpus = []
+    for _ in range(count):
+        roll = rand.random()
+        if roll < 0.01:
+            report[AXS_BYTE] = rand.choice(axis)
+        elif roll < 0.02:
+            report[SPD_BYTE] = rand.choice(speed)
+        elif roll < 0.1:
+            report[BTN_BYTE] = rand.choice(buttons)
+            report[BTN2_BYTE] = 0
+        report[ENC_BYTE] = rand.choice((0, 1, 1, 2, 5, 255, 255, 254, 251)) & 0xFF
+        corpus.append(bytearray(report))
+    return corpus
+
+
+def mixed_reports():
+    """
+    :return: a report sequence per button code: the code after an MPG-only report, alone and with the function
+             button held. Every sequence is checked from a fresh state.
+    """
+    fn_code = next(code for code, name in BTN_MAP.items() if name == 'fn_mode')
+    sequences = []
+    for code in sorted(set(BTN_MAP) | set(pendant_io.MACRO_MAP)):
+        reports = []
+        for btn, btn2 in ((0, 0), (code, 0), (0, 0), (fn_code, 0), (fn_code, code), (0, 0)):
+            report = bytearray(8)
+            report[0] = 0x04
+            report[AXS_BYTE] = list(AXS_MAP)[1]
+            report[SPD_BYTE] = list(SPD_MAP)[0]
+            report[BTN_BYTE], report[BTN2_BYTE] = btn, btn2
+            report[ENC_BYTE] = 0 if btn or btn2 else 1
+            reports.append(report)
+        sequences.append(reports)
+    return sequences
+
+
+def check(corpus):
+    """decode_report() must agree with read_data() called in a loop, the way the original driver used it"""
+    state = PendantState()
+    fn_mode, mpg_count = True, 0
+    for idx, data in enumerate(corpus):
+        decode_report(data, state)
+        buttons = read_data(data, fn_mode, mpg_count)
+        fn_mode, mpg_count = buttons['fn_mode'], buttons[pendant_io.MPG_KEY]
+        if state.as_dict() != buttons:
+            raise AssertionError('decode_report and read_data differ at report {}: {}'.format(idx, bytes(data).hex()))
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run(name, decode, corpus):
+    # throughput, the loop overhead is included
+    start = time.perf_counter()
+    for data in corpus:
+        decode(data)
+    elapsed = time.perf_counter() - start
+
+    # allocations: blocks still allocated after a report was decoded, and the memory it needs while decoding,
+    # freed or not
+    sample = corpus[:ALLOC_SAMPLE]
+    blocks_before = sys.getallocatedblocks()
+    for data in sample:
+        decode(data)
+    blocks = sys.getallocatedblocks() - blocks_before
+    allocated = 0
+    tracemalloc.start()
+    for data in sample:
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        decode(data)
+        allocated += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+
+    # latency, timed report by report
+    clock = time.perf_counter_ns
+    latencies = []
+    for data in corpus:
+        start_ns = clock()
+        decode(data)
+        latencies.append(clock() - start_ns)
+    latencies.sort()
+
+    print('{:<14} {:>9.0f} reports/s  p50 {:>6.2f} us  p99 {:>6.2f} us  p99.9 {:>6.2f} us  max {:>7.2f} us  '
+          '{:>6.3f} blocks kept  {:>5.0f} bytes peak'.format(name, len(corpus) / elapsed, percentile(latencies, 0.5) / 1e3,
+                                           percentile(latencies, 0.99) / 1e3, percentile(latencies, 0.999) / 1e3,
+                                           latencies[-1] / 1e3, blocks / float(len(sample)),
+                                           allocated / float(len(sample))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', help='capture recorded with pendant_capture.py, synthetic by default')
+    parser.add_argument('--reports', type=int, default=200000, help='size of the synthetic corpus')
+    parser.add_argument('--repeat', type=int, default=1, help='replay the corpus this many times')
+    args = parser.parse_args(argv)
+
+    if args.corpus:
+        corpus = [data for _, data in load_reports(args.corpus)]
+        print('{} reports from {}'.format(len(corpus), args.corpus))
+    else:
+        corpus = synthetic_corpus(args.reports)
+        print('{} synthetic reports'.format(len(corpus)))
+    corpus = corpus * args.repeat
+    for reports in mixed_reports():
+        check(reports)
+    check(corpus)
+
+    state = PendantState()
+    run('decode_report', lambda data: decode_report(data, state), corpus)
+
+    fn_mode, mpg_count = True, 0
+
+    def decode_dict(data):
+        nonlocal fn_mode, mpg_count
+        buttons = read_data(data, fn_mode, mpg_count)
+        fn_mode, mpg_count = buttons['fn_mode'], buttons[pendant_io.MPG_KEY]
+
+    run('read_data', decode_dict, corpus)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
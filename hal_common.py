@@ -0,0 +1,116 @@
+"""
+HAL helpers shared by the mega2560 and pendant drivers: the hal shim used when hal isn't available, udev hotplug
+events and s32 pin wrapping. Works with python 2 (mega2560_hal_io_pins.py) and python 3 (pendant_io.py).
+"""
+import logging
+
+S32_WRAP = 2 ** 31  # hal s32 counters roll over to 0 here
+
+log = logging.getLogger('hal_common')
+
+
+def wrap_s32(value):
+    """
+    Wrap a signed count into the hal s32 range the way a C int32 overflows, for counts that may go negative
+
+    >>> wrap_s32(-1), wrap_s32(S32_WRAP), wrap_s32(-S32_WRAP - 1)
+    (-1, -2147483648, 2147483647)
+    """
+    return (value + S32_WRAP) % (2 * S32_WRAP) - S32_WRAP
+
+
+class HalShim:
+    """
+    Provides a fake shim for hal, offers basic functionality and validation.
+    """
+    HAL_BIT = 1
+    HAL_IN = 2
+    HAL_OUT = 3
+    HAL_S32 = 4
+    HAL_FLOAT = 5
+    HAL_RW = 6
+
+    def __init__(self, name):
+        self._name = name
+        self._vals = {}
+        self._pins = {}
+        self._log = logging.getLogger(name)
+
+    @property
+    def log(self):
+        return self._log
+
+    def __getitem__(self, pin_name):
+        self.log.debug('get -> %s.%s=%s', self._name, pin_name, self._vals.get(pin_name))
+        return self._vals[pin_name]
+
+    def __setitem__(self, pin_name, value):
+        if pin_name not in self._pins:
+            raise KeyError('invalid pin name: {}'.format(pin_name))
+
+        self.log.debug('set -> %s.%s=%s', self._name, pin_name, self._vals.get(pin_name))
+        self._vals[pin_name] = value
+
+    def newpin(self, pin_name, data_type, direction):
+        self._pins[pin_name] = (data_type, direction)
+        self._vals[pin_name] = None
+
+    def newparam(self, param_name, data_type, direction):
+        self.newpin(param_name, data_type, direction)
+
+    def ready(self):
+        self.log.debug('{} ready'.format(self._name))
+
+    @staticmethod
+    def component(name):
+        return HalShim(name)
+
+    @staticmethod
+    def component_exists(name):
+        return False
+
+
+class HotplugMonitor(object):
+    """
+    Reports devices being plugged (back) in using udev events, so disconnected devices don't have to poll
+    run discovery. The monitor is select()-able.
+
+    Without pyudev (Windows) `available` is False and the caller has to fall back to polling.
+    """
+
+    def __init__(self, subsystem='tty', device_type=None, logger=None):
+        """
+        :param subsystem: udev subsystem to watch, e.g. "usb" with device_type "usb_device" for whole usb devices
+        :param logger: logger of the driver using the monitor
+        """
+        self._log = logger or log
+        self._monitor = None
+        try:
+            import pyudev
+            self._monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            self._monitor.filter_by(subsystem=subsystem, device_type=device_type)
+            self._monitor.start()
+        except Exception as e:
+            self._log.warning('udev hotplug events unavailable, falling back to polling - {}'.format(e))
+            self._monitor = None
+
+    @property
+    def available(self):
+        return self._monitor is not None
+
+    def fileno(self):
+        return self._monitor.fileno()
+
+    def events(self):
+        """
+        :return: list of the pyudev devices that were added since the last call, never blocks
+        """
+        added = []
+        if self._monitor is None:
+            return added
+        while True:
+            device = self._monitor.poll(timeout=0)
+            if device is None:
+                return added
+            if device.action == 'add':
+                added.append(device)
@@ -2,6 +2,7 @@ from __future__ import print_function
 
 import math
 import sys
+import pipes
 import subprocess
 from itertools import islice
 import logging
@@ -371,7 +372,10 @@ class IOButtonsBox(gtk.HBox):
 class IOPanel(gtk.ScrolledWindow):
     COMPONENT_NAME = 'iopanel'
     BUTTONS_PER_ROW = 10
-    UPDATE_FREQUENCY_MILLIS = 1000
+    # only the io pins get a button, the component's diagnostic pins (counters, timings, edge pins) are skipped
+    IO_PIN_PATTERN = re.compile(r'\.(input|output)-\d+$')
+    UPDATE_FREQUENCY_MILLIS = 50  # 20 Hz, only the pins of the panel's buttons are read, see PinWatcher
+    HALCMD_UPDATE_MILLIS = 1000  # without hal.get_value() every update runs halcmd, keep to the old 1 Hz
 
     def __init__(self,
                  component_name,
@@ -381,12 +385,16 @@ class IOPanel(gtk.ScrolledWindow):
                  hal_in_button=OutputButton,
                  hal_out_button=InputButton,
                  first_pin=0,
-                 columns=4):
+                 columns=4,
+                 update_millis=None):
         # member variables
         super(IOPanel, self).__init__()
         self._update_loop = False  # is the update loop running?
+        self._update_millis = update_millis  # None picks the rate that suits the PinWatcher, see start_updates()
         self._btn_boxes = {}
         self._pins = []
+        self._watched_buttons = {}  # pin name -> the button showing it
+        self._watcher = None  # PinWatcher, created by populate()
         self._hal_component = hal_component
         self._component_name = component_name
         self._hal_in_label = hal_in_label
@@ -500,6 +508,8 @@ class IOPanel(gtk.ScrolledWindow):
                 continue
             if self.component_name and not pin.get('NAME', '').startswith(self.component_name):
                 continue
+            if not self.IO_PIN_PATTERN.search(pin.get('NAME', '')):
+                continue
             if direction is not None and pin.get('DIRECTION', None) != direction:
                 continue
             pins.append({'pin': pin['NAME'], 'signal': pin_signals.get(pin['NAME']), 'direction': pin['DIRECTION']})
@@ -531,6 +541,8 @@ class IOPanel(gtk.ScrolledWindow):
                 continue
             if self.component_name and not pin.get('NAME', '').startswith(self.component_name or ''):
                 continue
+            if not self.IO_PIN_PATTERN.search(pin.get('NAME', '')):
+                continue
             if direction is not None and pin.get('DIRECTION', None) != direction:
                 continue
             pin_vals[pin['NAME']] = pin['VALUE']
@@ -549,7 +561,12 @@ class IOPanel(gtk.ScrolledWindow):
             self.start_updates()
 
     def start_updates(self):
-        gobject.timeout_add(self.UPDATE_FREQUENCY_MILLIS, self.update)
+        update_millis = self._update_millis
+        if update_millis is None:
+            direct = self._watcher is not None and self._watcher.direct
+            update_millis = self.UPDATE_FREQUENCY_MILLIS if direct else self.HALCMD_UPDATE_MILLIS
+        log.info('updating pin values every {}ms'.format(update_millis))
+        gobject.timeout_add(update_millis, self.update)
         self._update_loop = True
 
     def populate(self):
@@ -597,22 +614,31 @@ class IOPanel(gtk.ScrolledWindow):
             out_box.add_button(name=hal_out['pin'], button_obj=out_btn)
             log.debug('adding button {}: {} - {}'.format(self._hal_out_label, hal_out['pin'], hal_out['signal']))
 
+        # the pins are resolved once here, updates only read the values of these pins
+        for box in (in_box, out_box):
+            for pin_name, button in box.items():
+                self._watched_buttons[pin_name] = button
+        self._watcher = PinWatcher(sorted(self._watched_buttons), self.component_name)
+
         self.show_all()
         if not self._update_loop:
             self.start_updates()
 
     def update(self):
         """
-        Apply hal pin status to buttons, updating their visual representation based on pin value
+        Apply hal pin status to buttons, only the buttons whose pin value changed since the last update are restyled
         """
-        log.debug('updating pin states')
-        for io_label, hal_direction in {self._hal_in_label: hal.HAL_IN, self._hal_out_label: hal.HAL_OUT}.items():
-            button_box = self.get_button_box(io_label)
-            if not button_box:
-                continue
-            for pin_name, state in self.get_pin_values(direction=hal_direction).items():
-                log.debug('{} => {}'.format(pin_name, state))
-                button_box.set_button_state(btn_name=pin_name, active=state)
+        if self._watcher is None:
+            return True
+        try:
+            changes = self._watcher.changes()
+        except Exception as e:
+            # e.g. halcmd failing while hal shuts down, keep the timer running and try again next time
+            log.warning('unable to read pin values - {}'.format(e))
+            return True
+        for pin_name, state in changes:
+            log.debug('{} => {}'.format(pin_name, state))
+            self._watched_buttons[pin_name].set_button_state(active=state)
 
         return True
 
@@ -924,10 +950,12 @@ class HalCmd:
         """
 
     @classmethod
-    def exec_halcmd_show_pin(cls):
+    def exec_halcmd_show_pin(cls, pattern=None):
         """
         Return sequence of HalPinInfo()
 
+        :param pattern: only list the pins starting with this, e.g. a component name
+
         Parses hal output:
 
             Component Pins:
@@ -951,7 +979,8 @@ class HalCmd:
                 21  bit   IN          FALSE  axis.0.home-sw-in <== input-x-axis-limit
         :return:
         """
-        pins = subprocess.check_output(cls.HAL_PIN_CMD, shell=True)
+        command = cls.HAL_PIN_CMD if pattern is None else '{} {}'.format(cls.HAL_PIN_CMD, pipes.quote(pattern))
+        pins = subprocess.check_output(command, shell=True)
         log.debug('hal cmd pin output: {}'.format(pins))
         for pin_line in pins.strip().splitlines():
             # parse the pin-line into a data structure, if the line cannot be parsed None is returned
@@ -1011,7 +1040,7 @@ class HalCmd:
                 yield sig_info
 
     @classmethod
-    def get_info_pins(cls):
+    def get_info_pins(cls, pattern=None):
         """
         Simulates the response of the `hal.get_info_pins()` function
         by querying the halcmd cli directly
@@ -1026,9 +1055,11 @@ class HalCmd:
             {'NAME': 'mega2560.output-00', 'VALUE': False, 'DIRECTION': hal.HAL_IN},
         ]
 
+        :param pattern: only list the pins starting with this, e.g. a component name
         :return:
         """
-        return [{'NAME': pin.name, 'VALUE': pin.value, 'DIRECTION': pin.direction} for pin in cls.exec_halcmd_show_pin()]
+        return [{'NAME': pin.name, 'VALUE': pin.value, 'DIRECTION': pin.direction}
+                for pin in cls.exec_halcmd_show_pin(pattern)]
 
     @classmethod
     def get_info_signals(cls):
@@ -1048,6 +1079,55 @@ class HalCmd:
         return [{'NAME': sig.name, 'VALUE': sig.value, 'DRIVER': sig.driver, 'READERS': sig.readers} for sig in cls.exec_halcmd_show_sig()]
 
 
+class PinWatcher(object):
+    """
+    Watches the values of a fixed set of pins, resolved once when the panel is populated.
+
+    With `hal.get_value()` every watched pin is read directly, nothing else in the hal namespace is looked at.
+    Without it a single `halcmd show pin <component>` per poll lists just the component's pins.
+    """
+    UNSET = object()  # value of a pin that hasn't been read yet
+
+    def __init__(self, pin_names, component_name=None):
+        """
+        :param pin_names: the pins to watch
+        :param component_name: prefix the halcmd fallback lists, all pins if None
+        """
+        self.pin_names = tuple(pin_names)
+        self.component_name = component_name
+        self.values = dict.fromkeys(self.pin_names, self.UNSET)  # the value of each pin at the previous poll
+        self._get_value = getattr(hal, 'get_value', None)
+
+    @property
+    def direct(self):
+        """True when the pins are read with `hal.get_value()`, False when every read runs halcmd"""
+        return self._get_value is not None
+
+    def read(self):
+        """
+        :return: sequence of (pin-name, value) tuples of the watched pins
+        """
+        if self._get_value is not None:
+            get_value = self._get_value
+            return [(pin_name, get_value(pin_name)) for pin_name in self.pin_names]
+        values = self.values
+        return [(pin['NAME'], pin['VALUE']) for pin in HalCmd.get_info_pins(self.component_name)
+                if pin['NAME'] in values]
+
+    def changes(self):
+        """
+        :return: list of (pin-name, value) tuples of the pins whose value changed since the previous call, all pins
+                 on the first call
+        """
+        values = self.values
+        changed = []
+        for pin_name, value in self.read():
+            if values[pin_name] != value:
+                values[pin_name] = value
+                changed.append((pin_name, value))
+        return changed
+
+
 class HandlerClass:
     """
     Interacts with linuxcnc `gladvcp` plugin.
@@ -1056,6 +1136,7 @@ class HandlerClass:
     This gives us a hook into creating our interface
     """
     COMPONENT_ARGUMENT = 'component'
+    UPDATE_ARGUMENT = 'update_ms'  # -U update_ms=50, milliseconds between pin value updates, overrides the default
 
     def __init__(self, halcomp, builder, useropts):
         """
@@ -1089,14 +1170,17 @@ class HandlerClass:
             raise ValueError('cannot find "window1" - {}'.format(names))
 
         component_name = None
+        update_millis = None
         for argument in useropts:
             if argument.startswith(self.COMPONENT_ARGUMENT) and '=' in argument:
                 component_name = argument.split('=', 1)[-1]
+            elif argument.startswith(self.UPDATE_ARGUMENT) and '=' in argument:
+                update_millis = int(argument.split('=', 1)[-1])
 
-        self.main(window, component_name)
+        self.main(window, component_name, update_millis)
 
-    def main(self, window, component_name):
-        self.panel = IOPanel(component_name=component_name, hal_component=self.halcomp)
+    def main(self, window, component_name, update_millis=None):
+        self.panel = IOPanel(component_name=component_name, hal_component=self.halcomp, update_millis=update_millis)
         self.panel.populate()
         window.connect("show", self.panel.on_realize)
         window.connect("realize", self.panel.on_realize)
@@ -0,0 +1,294 @@
+"""
+Record/replay of the raw mega2560 serial stream
+
+A capture is an append-only binary log, it starts with CAPTURE_MAGIC followed by records:
+
+    [kind u8][timestamp u64 little endian, nanoseconds since the epoch][length u16][length bytes of data]
+
+    RECORD_SESSION  written every time a link reaches the running state, the data is
+                    [protocol u8][input count u16][output count u16][baud u32]
+    RECORD_RX       bytes exactly as they were read from the device
+    RECORD_TX       bytes exactly as they were written to the device
+
+The bytes are stored as they came off the port, not as decoded frames, so partial frames, line noise and resyncs
+replay exactly as they happened.
+
+ReplayPort plays the RX records of one session back through a pipe, it looks enough like a serial.Serial for the
+driver to select() on and read from, so a capture runs through the same decode path as a live device, at real time
+or as fast as it can be consumed.
+
+Usage:
+    python mega2560_capture.py capture.bin [--session -1] [--speed 0]
+
+decodes a capture and prints frame counts and decode throughput.
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import fcntl
+import select
+import struct
+import termios
+import argparse
+import threading
+
+from mega2560_protocol import PROTOCOL_LEGACY, PROTOCOL_FRAMED, LEGACY_DELIMITER, FRAME_DELIMITER, \
+    FrameBuffer, FrameError, FrameChecksumError, decode_input
+
+CAPTURE_MAGIC = b'M2560CAP\x01'  # file signature + format version
+RECORD_SESSION = 0
+RECORD_RX = 1
+RECORD_TX = 2
+RECORD_HEADER = struct.Struct('<BQH')
+SESSION = struct.Struct('<BHHI')
+MAX_RECORD = 0xFFFF  # longer writes are split over several records
+PROTOCOL_CODES = {PROTOCOL_LEGACY: 0, PROTOCOL_FRAMED: 1}
+PROTOCOL_NAMES = dict((code, name) for name, code in PROTOCOL_CODES.items())
+
+
+class CaptureError(ValueError):
+    pass
+
+
+class CaptureWriter(object):
+    """
+    Appends records to a capture file, every record is flushed so a capture survives the process being killed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, 'ab')
+        if self._fp.tell() == 0:
+            self._fp.write(CAPTURE_MAGIC)
+            self._fp.flush()
+
+    def session(self, protocol, input_count, output_count, baud, now=None):
+        self._write(RECORD_SESSION, SESSION.pack(PROTOCOL_CODES[protocol], input_count, output_count, baud), now)
+
+    def rx(self, data, now=None):
+        self._write(RECORD_RX, data, now)
+
+    def tx(self, data, now=None):
+        self._write(RECORD_TX, data, now)
+
+    def _write(self, kind, data, now):
+        timestamp = int((time.time() if now is None else now) * 1e9)
+        data = bytes(data)
+        for offset in range(0, len(data) or 1, MAX_RECORD):
+            chunk = data[offset:offset + MAX_RECORD]
+            self._fp.write(RECORD_HEADER.pack(kind, timestamp, len(chunk)))
+            self._fp.write(chunk)
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+
+def read_capture(fp):
+    """
+    Read the records of a capture file
+
+    :param fp: file object opened in binary mode
+    :return: generator of (kind, timestamp seconds, data) tuples, a record cut short by the end of the file is
+             dropped
+    """
+    if fp.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+        raise CaptureError('not a mega2560 capture (or an unsupported version): {}'.format(getattr(fp, 'name', fp)))
+
+    while True:
+        header = fp.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        kind, timestamp, length = RECORD_HEADER.unpack(header)
+        data = fp.read(length)
+        if len(data) < length:
+            return
+        yield kind, timestamp / 1e9, data
+
+
+def parse_session(data):
+    """
+    :return: dict with the protocol, input count, output count and baud rate of a RECORD_SESSION
+    """
+    code, input_count, output_count, baud = SESSION.unpack(data)
+    if code not in PROTOCOL_NAMES:
+        raise CaptureError('unknown protocol code in capture: {}'.format(code))
+    return {'protocol': PROTOCOL_NAMES[code], 'input_count': input_count, 'output_count': output_count,
+            'baud': baud}
+
+
+def load_sessions(path):
+    """
+    :return: list of (session dict, [(timestamp, rx data), ...]) in the order they were recorded
+    """
+    sessions = []
+    with open(path, 'rb') as fp:
+        for kind, timestamp, data in read_capture(fp):
+            if kind == RECORD_SESSION:
+                sessions.append((parse_session(data), []))
+            elif kind == RECORD_RX and sessions:
+                sessions[-1][1].append((timestamp, data))
+    return sessions
+
+
+class ReplayPort(object):
+    """
+    Plays the RX records of a captured session back through a pipe.
+
+    A feeder thread writes the records into the pipe, spaced the way they were captured when `speed` is 1.0,
+    `speed` 2.0 plays twice as fast and 0 as fast as the reader consumes them. When the session is exhausted the
+    port reports end of file by raising EOFError from read().
+
+    Only the parts of serial.Serial the driver uses are provided, writes are accepted and thrown away.
+    Linux only (select() on pipes, FIONREAD).
+    """
+
+    def __init__(self, path, speed=1.0, session=-1):
+        sessions = load_sessions(path)
+        if not sessions:
+            raise CaptureError('no sessions in capture: {}'.format(path))
+        info, self._records = sessions[session]
+        self.protocol = info['protocol']
+        self.input_count = info['input_count']
+        self.output_count = info['output_count']
+        self.baudrate = info['baud']
+        self.speed = speed
+        self.timeout = 0
+        self.port = path
+        self.bytes_written = 0
+        self._read_fd, self._write_fd = os.pipe()
+        self._thread = None
+        self._closed = threading.Event()
+
+    @property
+    def is_open(self):
+        return not self._closed.is_set()
+
+    def start(self):
+        """start playing the session, the time of the first record is taken as now"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._feed, name='mega2560-replay')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _feed(self):
+        start = time.time()
+        first = self._records[0][0] if self._records else 0.0
+        try:
+            for timestamp, data in self._records:
+                if self.speed:
+                    delay = start + (timestamp - first) / self.speed - time.time()
+                    if delay > 0 and self._closed.wait(delay):
+                        return
+                while data:
+                    if self._closed.is_set():
+                        return
+                    data = data[os.write(self._write_fd, data):]
+        except OSError:
+            pass  # the port was closed while we were writing
+        finally:
+            os.close(self._write_fd)
+
+    def fileno(self):
+        return self._read_fd
+
+    @property
+    def in_waiting(self):
+        return struct.unpack('i', fcntl.ioctl(self._read_fd, termios.FIONREAD, b'\0\0\0\0'))[0]
+
+    def read(self, size=1):
+        if self.timeout is not None and not select.select([self._read_fd], [], [], self.timeout)[0]:
+            return b''
+        data = os.read(self._read_fd, size)
+        if not data:
+            raise EOFError('replay of {} finished'.format(self.port))
+        return data
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return len(data)
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        os.close(self._read_fd)  # unblocks a feeder stuck in os.write()
+
+
+def replay_decode(port, count):
+    """
+    Run a replay through the same framing and decode path as the driver
+
+    :param port: a started ReplayPort
+    :param count: the number of inputs the frames describe
+    :return: dict of frame counters plus the time spent framing and decoding
+    """
+    frame_buffer = FrameBuffer(FRAME_DELIMITER if port.protocol == PROTOCOL_FRAMED else LEGACY_DELIMITER,
+                               synced=False)
+    result = {'frames-ok': 0, 'frames-bad-checksum': 0, 'frames-short': 0, 'changes': 0, 'bytes': 0,
+              'decode-seconds': 0.0}
+    previous_mask = None
+    port.timeout = None
+    while True:
+        try:
+            data = port.read(max(port.in_waiting, 1))
+        except EOFError:
+            return result
+
+        start = time.time()
+        result['bytes'] += len(data)
+        for frame in frame_buffer.feed(data):
+            try:
+                input_mask, _ = decode_input(port.protocol, frame, count)
+            except FrameChecksumError:
+                result['frames-bad-checksum'] += 1
+                continue
+            except FrameError:
+                result['frames-short'] += 1
+                continue
+            result['frames-ok'] += 1
+            if previous_mask is not None and input_mask != previous_mask:
+                result['changes'] += bin(input_mask ^ previous_mask).count('1')
+            previous_mask = input_mask
+        result['decode-seconds'] += time.time() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture', help='capture file written with CAPTURE_PATH')
+    parser.add_argument('--session', type=int, default=-1, help='session to replay, -1 is the most recent')
+    parser.add_argument('--speed', type=float, default=0.0, help='1.0 replays at real time, 0 as fast as possible')
+    args = parser.parse_args(argv)
+
+    sessions = load_sessions(args.capture)
+    for idx, (info, records) in enumerate(sessions):
+        duration = records[-1][0] - records[0][0] if records else 0.0
+        print('session {}: {protocol} protocol, {input_count} inputs, {output_count} outputs, {baud} baud, '
+              '{records} rx records over {duration:.1f}s'.format(idx, records=len(records), duration=duration,
+                                                                 **info))
+
+    port = ReplayPort(args.capture, speed=args.speed, session=args.session)
+    port.start()
+    started = time.time()
+    result = replay_decode(port, port.input_count)
+    elapsed = time.time() - started
+    port.close()
+
+    frames = result['frames-ok'] + result['frames-bad-checksum'] + result['frames-short']
+    print('frames ok: {frames-ok}, bad checksum: {frames-bad-checksum}, short: {frames-short}, '
+          'input changes: {changes}'.format(**result))
+    print('replayed {} bytes in {:.3f}s, decode {:.2f} us/frame, {:.0f} frames/s'.format(
+        result['bytes'], elapsed, result['decode-seconds'] / max(frames, 1) * 1e6,
+        frames / max(result['decode-seconds'], 1e-9)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+"""
+Input debounce and edge tracking for the mega2560 component
+
+Debouncing works on the packed input bitmask. Pins without debounce pass straight through as a single mask
+operation, only pins that currently disagree with their debounced state are looked at one by one, so a frame where
+nothing bounces costs a couple of integer operations regardless of the pin count.
+
+Per pin, one of:
+    time based   {"MS": 20}     a new state must be held for 20 ms before it is accepted
+    count based  {"COUNT": 3}   a new state must be seen in 3 consecutive frames before it is accepted
+
+Debounced states are only re-evaluated when a frame arrives, the device sends frames continuously so a time based
+pin is accepted at most one frame period late.
+"""
+
+
+def iter_bits(mask):
+    """
+    :return: generator of the pin numbers set in `mask`, lowest first
+
+    >>> list(iter_bits(0b10110))
+    [1, 2, 4]
+    """
+    while mask:
+        low_bit = mask & -mask
+        mask ^= low_bit
+        yield low_bit.bit_length() - 1
+
+
+class Debouncer(object):
+    """
+    Debounces an input bitmask and counts the edges of the debounced states.
+
+    >>> debounce = Debouncer(2, pins={'1': {'COUNT': 2}})
+    >>> debounce.update(0b00, 0.0), debounce.update(0b11, 0.01), debounce.update(0b11, 0.02)
+    (0, 1, 3)
+    >>> debounce.rise_counts, debounce.last_edge
+    ([1, 1], [0.01, 0.02])
+    """
+
+    def __init__(self, count, default_ms=0, pins=None):
+        """
+        :param count: number of inputs
+        :param default_ms: time based debounce for pins that aren't listed in `pins`, 0 disables
+        :param pins: dict of pin number (int or string, as it comes from json) to {"MS": ms} or {"COUNT": frames}
+        """
+        self.count = count
+        self.hold_seconds = [default_ms / 1000.0] * count
+        self.hold_frames = [0] * count
+        for pin, setting in (pins or {}).items():
+            pin = int(pin)
+            if not 0 <= pin < count:
+                raise ValueError('debounce configured for pin {}, only {} inputs'.format(pin, count))
+            if 'COUNT' in setting:
+                self.hold_frames[pin] = int(setting['COUNT'])
+                self.hold_seconds[pin] = 0.0
+            else:
+                self.hold_seconds[pin] = setting.get('MS', 0) / 1000.0
+
+        self.count_mask = 0  # pins debounced by frame count
+        self.time_mask = 0  # pins debounced by time
+        for pin in range(count):
+            if self.hold_frames[pin] > 1:
+                self.count_mask |= 1 << pin
+            elif self.hold_seconds[pin] > 0:
+                self.time_mask |= 1 << pin
+        self.debounced_mask = self.count_mask | self.time_mask
+
+        self.pending_since = [0.0] * count  # when the raw state of a pin last changed
+        self.pending_frames = [0] * count  # frames the raw state has been stable for
+        self.rise_counts = [0] * count
+        self.last_edge = [0.0] * count  # time of the most recent debounced edge, either direction
+        self.stable = None
+        self.raw = None
+        self.rising = 0  # pins that went on in the most recent update
+        self.falling = 0  # pins that went off in the most recent update
+        self.edges = 0
+
+    def reset(self):
+        """the next update is taken as the debounced state as it is, with no edges (a fresh connection)"""
+        self.stable = None
+        self.raw = None
+
+    def update(self, raw_mask, now):
+        """
+        :param raw_mask: input bitmask as decoded from a frame
+        :param now: time the frame arrived, seconds
+        :return: the debounced input bitmask
+        """
+        if self.stable is None:
+            self.stable = self.raw = raw_mask
+            self.rising = self.falling = self.edges = 0
+            return raw_mask
+
+        # a debounced pin that changed raw state (again) starts its hold time over
+        bounced = (raw_mask ^ self.raw) & self.debounced_mask
+        for pin in iter_bits(bounced):
+            self.pending_since[pin] = now
+            self.pending_frames[pin] = 0
+        self.raw = raw_mask
+
+        pending = raw_mask ^ self.stable
+        accepted = pending & ~self.debounced_mask
+        for pin in iter_bits(pending & self.debounced_mask):
+            self.pending_frames[pin] += 1
+            if self.pending_frames[pin] >= self.hold_frames[pin] and \
+                    now - self.pending_since[pin] >= self.hold_seconds[pin]:
+                accepted |= 1 << pin
+
+        self.edges = accepted
+        if accepted:
+            self.stable ^= accepted
+            self.rising = accepted & self.stable
+            self.falling = accepted & ~self.stable
+            for pin in iter_bits(accepted):
+                self.last_edge[pin] = now
+            for pin in iter_bits(self.rising):
+                self.rise_counts[pin] += 1
+        else:
+            self.rising = self.falling = 0
+        return self.stable
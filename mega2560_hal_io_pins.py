@@ -16,200 +16,373 @@ PYTHON_REQUIRED_VERSION = 2
 PYTHON_MAJOR_VERSION = sys.version_info[0]
 
 # ==== CONSTANTS ===================
-WARMUP_READS = 25  # We will read from the device this many times to let flow-control establish itself before trying
-                  # to process the message "for real"
-CPU_SLEEP_SECONDS = 0.001  # this provides time back to the CPU, no reason to run as fast as possible.
+HAL_SYNC_SECONDS = 0.005  # the hal stage applies the newest inputs and picks up output changes this often
+OUTPUT_KEEPALIVE_SECONDS = 0.1  # unchanged outputs are re-sent this often, MUST be below the firmware watchdog timeout
+OUTPUT_KEEPALIVE_MIN_SECONDS = 0.01  # the output-keepalive-ms parameter is clamped to this range, the upper limit
+OUTPUT_KEEPALIVE_MAX_SECONDS = 0.25  # leaves a missed keepalive of margin below the 0.5s firmware watchdog
 BAUD_RATE = 9600  # BAUD_RATE must match the mega2560 programmed rate.
                   # The parameter baudrate can be one of the standard values:
                   #  50, 75, 110, 134, 150, 200, 300, 600, 1200, 1800, 2400, 4800, 9600, 19200, 38400, 57600, 115200.
                   #  These are well supported on all platforms.
+                  # The link always starts at BAUD_RATE, with the framed protocol it is stepped up to the highest
+                  # rate in BAUD_RATES (up to MAX_BAUD_RATE) that passes a loopback test.
+BAUD_RATES = (19200, 38400, 57600, 115200)
+BAUD_ERROR_WINDOW_SECONDS = 5.0  # window used to judge the error rate of a tuned link
+BAUD_ERROR_LIMIT = 10  # bad frames per window that make us reconnect at the next lower baud rate
 
 CONFIGURATION_NAME = 'mega2560_hal_io_config.json'  # the configuration file will be loaded from the same directory
                                                     # as this script.
-INITIALIZE_WAIT_SECONDS = 1.0  # Pause for a few seconds to ensure the mega is given time to initialize
+INITIALIZE_WAIT_SECONDS = 1.0  # Pause after every (re)connect to ensure the mega is given time to initialize
+RECONNECT_WAIT_SECONDS = 1.0  # longest wait for a hotplug event before discovery is retried
+SERIAL_BY_ID_DIR = '/dev/serial/by-id/'  # stable device links, they survive ttyACM renumbering
 REPORT_INTERVAL_SECONDS = 10.0  # You will only see the pin status report if logging is set to INFO
-INPUT_MSG_PREFIX = 2  # tells us how many bytes are at the start of input messages before input states begin.
-INPUT_MSG_SUFFIX = 1
-PIN_OFF = chr(1)  # these constants are set in the microcontroller
-PIN_ON = chr(100)
-CHECKSUM_ON = 3
-CHECKSUM_OFF = 2
 DEFAULT_BIT_PIN_STATE = False  # default state is OFF
+STATS_PUBLISH_SECONDS = 0.05  # how often the link statistics pins are updated
+LOG_RELAY_RECORDS = 1000  # log records waiting for the reporter thread, the oldest are dropped beyond this
+LOG_RELAY_SECONDS = 0.1  # how often the reporter thread hands queued log records to syslog
+ERROR_LOG_RATE = 1.0  # link errors logged per second once the burst is used up, the rest are only counted
+ERROR_LOG_BURST = 10  # link errors logged back to back before the rate limit applies
+JITTER_BUCKETS_MS = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0)  # upper edges of the jitter histogram buckets, the last
+                                                           # pin (jitter-bucket-07) counts everything above 50ms
 SERIAL_OPTIONS = {
     'xonxoff': False,  # software flow-control, both `xonxoff` and `rtscts` cannot be enabled.
     'rtscts': True,  # hardware flow control RTS/CTS (available on Linux)
     'dsrdtr': None,  # setting this to None will mean it follows the `rtscts` setting
     'timeout': 1,
     'write_timeout': 2,
+    'exclusive': True,  # (POSIX) two devices can never end up sharing one port
 }
 
-if sys.version_info[0] != PYTHON_REQUIRED_VERSION:
-    raise RuntimeError('Invalid python version! ({})\n' \
-        'LinuxCNC is currently only compatible with Python {} \n' \
-        'When LinuxCNC 2.9 is officially released it will support Python 3'.format(PYTHON_MAJOR_VERSION,
-                                                                                   PYTHON_REQUIRED_VERSION))
-
-from os.path import join, dirname
+import os
+from os.path import join, dirname, abspath
 import json
 import time
+import fcntl
+import select
+import threading
+from collections import deque, namedtuple
 import logging
 import logging.handlers
 logging.basicConfig()
 try:
     import serial
+    import serial.tools.list_ports
+    from serial.serialutil import SerialTimeoutException
 except ImportError as e:
-    raise ImportError('"pyserial" is not available, install with "python -m pip install pyserial" - {}'.format(e))
-import serial.tools.list_ports
-from serial.serialutil import SerialException, \
-    PortNotOpenError, SerialTimeoutException, Timeout
+    # pyserial is only needed to open real devices, replays and benchmarks run without it
+    serial = None
+    SERIAL_IMPORT_ERROR = e
+    SerialTimeoutException = IOError  # pyserial's SerialTimeoutException is an IOError too
+from hal_common import S32_WRAP, HalShim, HotplugMonitor
+from mega2560_protocol import PROTOCOL_LEGACY, PROTOCOL_FRAMED, PROTOCOLS, FRAME_DELIMITER, \
+    LEGACY_DELIMITER, FrameBuffer, FrameError, FrameChecksumError, OutputEncoder, decode_input, format_mask, \
+    negotiate_protocol, tune_baud
+from mega2560_capture import CaptureWriter, ReplayPort
+from mega2560_debounce import Debouncer
 
 
 class DeviceNotFound(NameError):
     pass
 
 
-class HalShim:
+class LinkStats(object):
     """
-    Provides a fake shim for hal, offers basic functionality and validation.
+    Link health and timing statistics, published as hal pins so they can be watched with halscope/halmeter
+
+    frames-ok, frames-bad-checksum,     (s32) frame counters
+    frames-short, reconnects
+    time-to-frame-{last,min,max,mean}-ms
+                                        (float) time from an output write to the next valid input frame. The
+                                        device sends input frames on its own schedule, so this is where in the
+                                        frame period the write landed, not a round trip through the firmware
+    period-ms                           (float) time between the last two valid input frames (one I/O cycle)
+    jitter-ms                           (float) deviation of period-ms from the average period
+    jitter-bucket-NN                    (s32) histogram of jitter-ms, bucket edges are JITTER_BUCKETS_MS
+    frames-per-second                   (float) valid input frames per second
+    baud-rate                           (s32) baud rate of the current connection
     """
-    HAL_BIT = 1
-    HAL_IN = 2
-    HAL_OUT = 3
-
-    def __init__(self, name):
-        self._name = name
-        self._vals = {}
-        self._pins = {}
-        self._log = logging.getLogger(name)
+    COUNTERS = ('frames-ok', 'frames-bad-checksum', 'frames-short', 'reconnects')
+    TIMINGS = ('time-to-frame-last-ms', 'time-to-frame-min-ms', 'time-to-frame-max-ms', 'time-to-frame-mean-ms',
+               'period-ms', 'jitter-ms', 'frames-per-second')
+    GAUGES = ('baud-rate',)
+    PERIOD_SMOOTHING = 0.05  # weight of the newest period in the running average period
+    RATE_WINDOW_SECONDS = 1.0  # frames-per-second is measured over this window
+
+    def __init__(self, buckets_ms=JITTER_BUCKETS_MS):
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.timings = dict.fromkeys(self.TIMINGS, 0.0)
+        self.gauges = dict.fromkeys(self.GAUGES, 0)
+        self.buckets_ms = tuple(buckets_ms)
+        self.histogram = [0] * (len(self.buckets_ms) + 1)
+        self.bucket_names = ['jitter-bucket-{:02d}'.format(i) for i in range(len(self.histogram))]
+        self._wait_total = 0.0
+        self._wait_count = 0
+        self._write_time = None
+        self._frame_time = None
+        self._mean_period = None
+        self._rate_start = None
+        self._rate_frames = 0
+
+    def create_pins(self, component, hal):
+        for name in self.COUNTERS + self.GAUGES:
+            component.newpin(name, hal.HAL_S32, hal.HAL_OUT)
+        for name in self.TIMINGS:
+            component.newpin(name, hal.HAL_FLOAT, hal.HAL_OUT)
+        for name in self.bucket_names:
+            component.newpin(name, hal.HAL_S32, hal.HAL_OUT)
+
+    def count(self, name):
+        self.counters[name] += 1
+
+    def output_written(self, now):
+        # only the first write after an input frame starts a measurement, keepalives don't restart it
+        if self._write_time is None:
+            self._write_time = now
+
+    def frame_received(self, now):
+        self.counters['frames-ok'] += 1
+        timings = self.timings
+
+        if self._write_time is not None:
+            wait = (now - self._write_time) * 1000.0
+            self._write_time = None
+            self._wait_total += wait
+            self._wait_count += 1
+            timings['time-to-frame-last-ms'] = wait
+            timings['time-to-frame-mean-ms'] = self._wait_total / self._wait_count
+            if self._wait_count == 1 or wait < timings['time-to-frame-min-ms']:
+                timings['time-to-frame-min-ms'] = wait
+            timings['time-to-frame-max-ms'] = max(timings['time-to-frame-max-ms'], wait)
+
+        if self._frame_time is not None:
+            period = (now - self._frame_time) * 1000.0
+            if self._mean_period is None:
+                self._mean_period = period
+            jitter = abs(period - self._mean_period)
+            self._mean_period += (period - self._mean_period) * self.PERIOD_SMOOTHING
+            timings['period-ms'] = period
+            timings['jitter-ms'] = jitter
+            bucket = 0
+            for edge in self.buckets_ms:
+                if jitter <= edge:
+                    break
+                bucket += 1
+            self.histogram[bucket] += 1
+        self._frame_time = now
+
+    def reset_timing(self):
+        # used after a reconnect or while warming up, the next frame doesn't end a normal I/O cycle
+        self._write_time = None
+        self._frame_time = None
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def publish(self, component, now):
+        frames = self.counters['frames-ok']
+        if self._rate_start is None:
+            self._rate_start, self._rate_frames = now, frames
+        elif now - self._rate_start >= self.RATE_WINDOW_SECONDS:
+            self.timings['frames-per-second'] = (frames - self._rate_frames) / (now - self._rate_start)
+            self._rate_start, self._rate_frames = now, frames
+
+        for name, value in self.counters.items():
+            component[name] = value % S32_WRAP
+        for name, value in self.gauges.items():
+            component[name] = value
+        for name, value in self.timings.items():
+            component[name] = value
+        for name, value in zip(self.bucket_names, self.histogram):
+            component[name] = value % S32_WRAP
+
+
+class LogRelay(logging.Handler):
+    """
+    Queues log records for the reporter thread, so a slow syslog never stalls the thread that logged.
 
-    @property
-    def log(self):
-        return self._log
+    The queue is bounded, when the reporter falls behind the oldest records are dropped (and counted) instead.
+    """
 
-    def __getitem__(self, pin_name):
-        self.log.debug('get -> {}.{}={}'.format(self._name, pin_name, self._vals.get(pin_name)))
-        return self._vals[pin_name]
+    def __init__(self, target, max_records=LOG_RELAY_RECORDS):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.records = deque(maxlen=max_records)
+        self.dropped = 0
+
+    def emit(self, record):
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append(record)  # deque.append is atomic, no lock needed between the threads
+
+    def relay(self):
+        """hand the queued records to the target handler, called from the reporter thread (and once on exit)"""
+        while True:
+            try:
+                record = self.records.popleft()
+            except IndexError:
+                break
+            self.target.handle(record)
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            self.target.handle(logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': '{} log records dropped, syslog is too slow'.format(dropped)}))
+
+
+class ErrorLog(object):
+    """
+    Counts link errors per error class and logs them through a token bucket, so a noisy cable can't flood syslog.
 
-    def __setitem__(self, pin_name, value):
-        if pin_name not in self._pins:
-            raise KeyError('invalid pin name: {}'.format(pin_name))
+    Messages are formatted lazily by logging, and only for the records that get past the bucket. Every error is
+    counted, summary() reports the counts and how many messages were suppressed since the previous summary.
+    Records carry the error class as `error_class`, the summary carries its counts as `error_counts`.
 
-        self.log.debug('set -> {}.{}={}'.format(self._name, pin_name, self._vals.get(pin_name)))
-        self._vals[pin_name] = value
+    error() is called from the I/O thread and summary() from the reporter thread, each owns the state it writes.
+    """
 
-    def newpin(self, pin_name, data_type, direction):
-        self._pins[pin_name] = (data_type, direction)
-        self._vals[pin_name] = None
+    def __init__(self, logger, rate=ERROR_LOG_RATE, burst=ERROR_LOG_BURST):
+        self.logger = logger
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled = time.time()
+        self.totals = {}  # error class -> errors since startup
+        self.suppressed = 0  # messages dropped by the bucket since startup
+        self.summarized = {}  # totals as of the previous summary
+        self.summarized_suppressed = 0
+
+    def error(self, error_class, msg, *args):
+        """
+        Count an error and log it if the bucket has a token left
+
+        :param error_class: short name the error is counted under, e.g. "bad-checksum"
+        :param msg: logging format string, formatted with `args` only if the record is emitted
+        """
+        self.totals[error_class] = self.totals.get(error_class, 0) + 1
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        if self.tokens < 1.0:
+            self.suppressed += 1
+            return
+        self.tokens -= 1.0
+        self.logger.warning(msg, *args, extra={'error_class': error_class})
+
+    def summary(self):
+        """log the errors counted since the previous summary, nothing is logged if there weren't any"""
+        totals = dict(self.totals)
+        suppressed = self.suppressed
+        counts = dict((error_class, total - self.summarized.get(error_class, 0))
+                      for error_class, total in totals.items() if total != self.summarized.get(error_class, 0))
+        if counts:
+            self.logger.warning('link errors: %s (%d messages suppressed)',
+                                ', '.join('{}: {}'.format(name, count) for name, count in sorted(counts.items())),
+                                suppressed - self.summarized_suppressed, extra={'error_counts': counts})
+        self.summarized = totals
+        self.summarized_suppressed = suppressed
+
+
+# The I/O thread hands inputs to the hal stage as immutable snapshots. Publishing is a single reference assignment
+# (atomic under the GIL), the hal stage always picks up the newest one and never waits on the I/O thread.
+InputSnapshot = namedtuple('InputSnapshot', (
+    'raw_mask',  # input states as decoded from the last frame
+    'input_mask',  # debounced input states
+    'changed_total',  # debounced input state changes since startup
+    'edge_total',  # number of updates that had debounced edges, the edge tuples below only change with it
+    'rise_counts',  # tuple, debounced rising edges per pin
+    'last_edge',  # tuple, time of the last debounced edge per pin
+))
+
+
+log = logging.getLogger('mega2560')
+log.setLevel(logging.INFO)
 
-    @staticmethod
-    def component(name):
-        return HalShim(name)
 
-    @staticmethod
-    def component_exists(name):
-        return False
+# === READ CONFIGURATION ===========
+def load_config(conf_path=None):
+    """
+    Read the program configuration
 
+    :param conf_path: json file to read, CONFIGURATION_NAME in the directory of this script by default
+    :return: dict
+    """
+    if conf_path is None:
+        conf_path = join(dirname(abspath(__file__)), CONFIGURATION_NAME)
+    try:
+        conf_fp = open(conf_path, mode='r')
+    except IOError as e:
+        raise IOError('unable to open file {}, - {}'.format(conf_path, e))
 
-# === READ CONFIGURATION ===========
-conf_path = join(dirname(__file__), CONFIGURATION_NAME)
-try:
-    conf_fp = open(conf_path, mode='r')
-except IOError as e:
-    raise IOError('unable to open file {}, - {}'.format(conf_path, e))
+    with conf_fp:
+        try:
+            return json.load(conf_fp)
+        except ValueError as e:
+            raise ValueError('error reading program configuration, invalid json: {}, - {}'.format(conf_path, e))
 
-try:
-    conf = json.load(conf_fp)
-except json.DecodeError as e:
-    raise json.DecoderError('error reading program configuration, invalid json: {}, - {}'.format(conf_path, e))
 
 # === CONFIG VALUES ================
-COMPONENT = conf['COMPONENT']  # this is the prefix the pin name will start with.
-INPUT_COUNT = conf['INPUT_COUNT']  # pin-number that pins will start at, usually 0 or 1
-OUTPUT_COUNT = conf['OUTPUT_COUNT']  # the number of outputs the device supports and is configured for
-DEVICE_DESCRIPTION = conf['DEVICE_DESCRIPTION'] # the device description via USB - we will connect to this USB device.
-DEVICE_SERIAL = conf['DEVICE_SERIAL']  # (optional) if multiple devices are connected, you can specify the serial number of the device to
-                                       # connect to, to disambiguate them from eachother.
-LOG_LEVEL = conf['LOG_LEVEL']
-log = logging.getLogger(COMPONENT)
-log.setLevel(logging.INFO)
+# Each entry of DEVICES describes one board and is serviced by this one process:
+#   COMPONENT           this is the prefix the pin names will start with, every device needs its own
+#   INPUT_COUNT         the number of inputs the device supports and is configured for
+#   OUTPUT_COUNT        the number of outputs the device supports and is configured for
+#   DEVICE_DESCRIPTION  the device description via USB - we will connect to this USB device.
+#   DEVICE_SERIAL       (optional) if multiple devices are connected, you can specify the serial number of the device
+#                       to connect to, to disambiguate them from eachother.
+#   PROTOCOL            (optional) overrides the top level PROTOCOL for this device
+#   MAX_BAUD_RATE       (optional) overrides the top level MAX_BAUD_RATE for this device
+#   DEBOUNCE_MS         (optional) time based debounce for every input, 0 (default) disables
+#   DEBOUNCE            (optional) per input overrides, {"12": {"MS": 20}, "13": {"COUNT": 3}}, see mega2560_debounce.py
+#   DEVICE_PORT         (optional) open this port instead of searching for the device, e.g. a simulator pty
+#   CAPTURE_PATH        (optional) append the raw serial traffic of this device to a capture file
+#   REPLAY_PATH         (optional) replay a capture file instead of connecting to the device, the HAL pins follow
+#                       the captured inputs and outputs are discarded. Replay starts over when the capture ends.
+#   REPLAY_SPEED        (optional) 1.0 (default) replays at real time, 0 as fast as possible
+#   OUTPUT_KEEPALIVE_MS (optional) unchanged outputs are re-sent this often, 100 (default). Changed outputs are
+#                       always sent right away. Also the initial value of the output-keepalive-ms hal parameter.
+# A configuration without DEVICES describes a single device with the keys above at the top level.
+#
+# Top level:
+#   LOG_LEVEL           syslog level, e.g. "WARNING"
+#   PROTOCOL            "legacy" (default), "framed", or "auto" which negotiates the framed protocol and falls back
+#                       to "legacy". "auto" and "framed" send the framed handshake, only use them with firmware that
+#                       understands it.
+#   MAX_BAUD_RATE       highest rate the link may be tuned to, BAUD_RATE (default) disables tuning
+
+
+def discover_port(description, serial_number=None):
+    """
+    discover the serial port name where the arduino device is located
 
-try:
-    import hal
-    handler = logging.handlers.SysLogHandler(address='/dev/log')
-    log.addHandler(handler)
-    log.setLevel(getattr(logging, LOG_LEVEL))
-except ImportError:
-    # if HAL isn't available we will provide a simple shim
-    # so the program  can be verified.
-    log.warning('hal unavailable, providing shim layer for debugging')
-    hal = HalShim
-
-if not isinstance(INPUT_COUNT, int):
-    raise ValueError('INPUT_COUNT invalid')
-if not isinstance(OUTPUT_COUNT, int):
-    raise ValueError('OUTPUT_COUNT invalid')
-
-INPUT_NAMES = {}  # map HARDWARE PIN NUMBER (0 BASED) to tuple (Software pin name, Software pin name not)
-OUTPUT_NAMES = {}  # map HARDWARE PIN NUMBER (0 BASED) to tuple (Software pin name, Software pin name not)
-
-# ================================================
-# === CONFIGURE HAL COMPONENT ====================
-# ================================================
-io = hal.component(COMPONENT)
-
-# setup input pins
-for i in range(INPUT_COUNT):
-    # pin names are "component-input-00"
-    #               "component-input-00-not"
-    name = 'input-{:02d}'.format(i)
-    not_name = 'input-{:02d}-not'.format(i)  # configure an inverse pin - this makes it use to test for NOT
-    io.newpin(name, hal.HAL_BIT, hal.HAL_OUT)
-    io.newpin(not_name, hal.HAL_BIT, hal.HAL_OUT)
-
-    INPUT_NAMES[i] = (name, not_name)
-
-
-# setup output pins
-for i in range(OUTPUT_COUNT):
-    name = 'output-{:02d}'.format(i)
-    io.newpin(name, hal.HAL_BIT, hal.HAL_IN)
-
-    OUTPUT_NAMES[i] = name
-
-# very important
-io.ready()
-log.debug('hal component {} is ready'.format(COMPONENT))
-
-
-def discover_port():
-    """discover the serial port name where the arduino device is located"""
+    :param description: the device description via USB (DEVICE_DESCRIPTION)
+    :param serial_number: (optional) the device serial number (DEVICE_SERIAL), when given it must match
+    """
     if platform.system() == 'Windows':
-        return discover_port_serial()
+        return discover_port_serial(description, serial_number)
     else:
-        return discover_port_udev()
+        return discover_port_udev(description, serial_number)
 
 
-def discover_port_serial():
+def discover_port_serial(description, serial_number=None):
     serial_port = None
     devices = []
     ports = list(serial.tools.list_ports.comports())
     for port in ports:
 
         devices.append('{}, {}'.format(port.name, port.description))
-        if port.description is not None and DEVICE_DESCRIPTION not in port.description:
+        if port.description is not None and description not in port.description:
             continue
-        if DEVICE_SERIAL is not None and DEVICE_SERIAL != port.serial:
+        if serial_number is not None and serial_number != port.serial:
             continue
         serial_port = port.name
 
     if not serial_port:
         raise DeviceNotFound('USB Device not found, DESCRIPTION: {}, SERIAL: {}\n' \
-            'AVAILABLE DEVICES:\n{}'.format(DEVICE_DESCRIPTION, DEVICE_SERIAL, '\n'.join(devices)))
+            'AVAILABLE DEVICES:\n{}'.format(description, serial_number, '\n'.join(devices)))
 
     return serial_port
 
 
-def discover_port_udev():
+def discover_port_udev(description, serial_number=None):
     """
     On linux pyserial will not be able to list usb tty devices.
 
@@ -259,177 +432,866 @@ def discover_port_udev():
     # note that you MUST ask for a specific context otherwise you won't get pertinant usb information
     # the subsystem below is REQUIRED
     for device in context.list_devices(subsystem='tty', ID_BUS='usb'):
-        for value in device.values():
-            if DEVICE_DESCRIPTION is not None and DEVICE_DESCRIPTION in value:
-                serial_port = device['DEVNAME']
-                continue
-
-            if DEVICE_SERIAL is not None and DEVICE_SERIAL in value:
-                serial_port = device['DEVNAME']
-                continue
+        port = match_udev_device(device, description, serial_number)
+        if port:
+            serial_port = port
+            continue
 
-            devices.append('{}, MODEL: {}, SERIAL: {}'.format(device['DEVNAME'],
-                                                              device['ID_MODEL_FROM_DATABASE'],
-                                                              device['ID_SERIAL_SHORT']))
+        devices.append('{}, MODEL: {}, SERIAL: {}'.format(device.get('DEVNAME'),
+                                                          device.get('ID_MODEL_FROM_DATABASE'),
+                                                          device.get('ID_SERIAL_SHORT')))
 
     if not serial_port:
         raise DeviceNotFound('USB Device not found, DESCRIPTION: {}, SERIAL: {}\n' \
-            'AVAILABLE DEVICES:\n{}'.format(DEVICE_DESCRIPTION, DEVICE_SERIAL, '\n'.join(devices)))
+            'AVAILABLE DEVICES:\n{}'.format(description, serial_number, '\n'.join(devices)))
     return serial_port
 
 
-# =============================================
-# ==== MAIN LOOP ==============================
-# =============================================
-tlast = time.time()
-start_time = time.time()
-warmup_counter = WARMUP_READS
-in_counter = 0
-out_counter = 0
-arduino = None
-while 1:
+def match_udev_device(device, description, serial_number=None):
+    """
+    Check a pyudev tty device against a device description / serial number
+
+    :param device: pyudev Device
+    :param description: the device description via USB (DEVICE_DESCRIPTION)
+    :param serial_number: (optional) when given the device must have this serial number
+    :return: the port to open if the device matches, otherwise None. The /dev/serial/by-id/ link is preferred over
+             DEVNAME because it stays the same when the device comes back as a different ttyACM number.
+    """
+    if device.get('ID_BUS') != 'usb':
+        return None
+
+    values = list(device.values())
+    if serial_number is not None:
+        matched = any(serial_number in value for value in values)
+    else:
+        matched = description is not None and any(description in value for value in values)
+    if not matched:
+        return None
+
+    for link in device.get('DEVLINKS', '').split():
+        if link.startswith(SERIAL_BY_ID_DIR):
+            return link
+    return device.get('DEVNAME')
+
+
+def close_port(port):
+    """close a serial port, ignoring errors from a device that has already gone away"""
+    if port is None:
+        return
+    try:
+        port.close()
+    except Exception as e:
+        log.debug('error closing port - {}'.format(e))
+
+
+# Connecting is a small state machine:
+#   LINK_DISCONNECTED - find the port (hotplug event, cached port, then discovery). When nothing is found the
+#                       device waits for udev to report a matching device, without udev events it retries every
+#                       RECONNECT_WAIT_SECONDS
+#   LINK_INITIALIZING - the mega resets when the port is opened, drain the port until it has initialized
+#   LINK_RUNNING      - negotiate the protocol once, then exchange frames. Any failure goes back to LINK_DISCONNECTED
+LINK_DISCONNECTED = 'disconnected'
+LINK_INITIALIZING = 'initializing'
+LINK_RUNNING = 'running'
+
+
+class Mega2560Device(object):
+    """
+    One Arduino board: its hal component, its serial link and the protocol state of that link.
+
+    Every device runs in two stages that only share immutable values:
+        I/O thread  (io_loop)   owns the port: connects, reads and decodes frames, debounces, writes outputs.
+                                Publishes an InputSnapshot per frame and never touches hal.
+        hal stage   (sync_hal)  runs on the main thread every HAL_SYNC_SECONDS: applies the newest snapshot to
+                                the hal pins and posts the hal output states to `output_request`.
+    Discovery, reconnects or a slow serial port only delay the I/O thread of that device, the hal stage keeps its
+    period. Reports are logged from the reporter thread.
+    """
+
+    def __init__(self, device_conf, device_log=None):
+        """
+        :param device_conf: one entry of DEVICES, with the top level PROTOCOL and MAX_BAUD_RATE as defaults
+        :param device_log: logger, by default one named after the component
+        """
+        self.component_name = device_conf['COMPONENT']  # this is the prefix the pin name will start with.
+        self.input_count = device_conf['INPUT_COUNT']
+        self.output_count = device_conf['OUTPUT_COUNT']
+        self.description = device_conf.get('DEVICE_DESCRIPTION')
+        self.serial_number = device_conf.get('DEVICE_SERIAL')
+        self.device_port = device_conf.get('DEVICE_PORT')
+        self.protocol_setting = device_conf.get('PROTOCOL', PROTOCOL_LEGACY)
+        self.max_baud_rate = device_conf.get('MAX_BAUD_RATE', BAUD_RATE)
+        self.capture_path = device_conf.get('CAPTURE_PATH')
+        self.replay_path = device_conf.get('REPLAY_PATH')
+        self.replay_speed = device_conf.get('REPLAY_SPEED', 1.0)
+        self.keepalive_ms = device_conf.get('OUTPUT_KEEPALIVE_MS', OUTPUT_KEEPALIVE_SECONDS * 1000)
+        self.log = device_log or logging.getLogger(self.component_name)
+
+        if not isinstance(self.input_count, int):
+            raise ValueError('{}: INPUT_COUNT invalid'.format(self.component_name))
+        if not isinstance(self.output_count, int):
+            raise ValueError('{}: OUTPUT_COUNT invalid'.format(self.component_name))
+        if not isinstance(self.max_baud_rate, int) or self.max_baud_rate < BAUD_RATE:
+            raise ValueError('{}: MAX_BAUD_RATE invalid, must be at least {}'.format(self.component_name, BAUD_RATE))
+        if self.protocol_setting not in PROTOCOLS:
+            raise ValueError('{}: PROTOCOL invalid, must be one of: {}'.format(self.component_name,
+                                                                               ', '.join(PROTOCOLS)))
+        if not isinstance(self.keepalive_ms, (int, float)) or \
+                not OUTPUT_KEEPALIVE_MIN_SECONDS <= self.keepalive_ms / 1000.0 <= OUTPUT_KEEPALIVE_MAX_SECONDS:
+            raise ValueError('{}: OUTPUT_KEEPALIVE_MS invalid, must be {:g} to {:g}'.format(
+                self.component_name, OUTPUT_KEEPALIVE_MIN_SECONDS * 1000, OUTPUT_KEEPALIVE_MAX_SECONDS * 1000))
+
+        self.io = None
+        self.capture = CaptureWriter(self.capture_path) if self.capture_path else None
+        self.input_names = {}  # map HARDWARE PIN NUMBER (0 BASED) to tuple (Software pin name, Software pin name not)
+        self.output_names = {}  # map HARDWARE PIN NUMBER (0 BASED) to Software pin name
+        self.edge_names = {}  # map HARDWARE PIN NUMBER (0 BASED) to tuple (rise count pin name, last edge pin name)
+        self.stats = LinkStats()
+        self.errors = ErrorLog(self.log)
+        self.debouncer = Debouncer(self.input_count, device_conf.get('DEBOUNCE_MS', 0), device_conf.get('DEBOUNCE'))
+        self.started = time.time()  # the -last-edge-ns pins count from here
+
+        # link state
+        self.port = None
+        self.link_state = LINK_DISCONNECTED
+        self.retry_at = 0.0  # None while waiting for a hotplug event
+        self.connect_time = 0.0
+        self.connected_once = False
+        self.cached_port = None  # last port that connected successfully, tried before running discovery
+        self.hotplug_port = None  # port reported by the most recent matching hotplug event
+        self.hotplug_available = False  # set by the driver when udev events are passed to hotplug_added()
+        self.hotplug_count = 0  # matching hotplug events, a discovery that raced with one is retried
+        self.reported_missing = False  # "device not found" is logged once per disconnect
+        self.protocol = None
+        self.frame_buffer = None
+        self.output_encoder = None
+        self.baud_cap = self.max_baud_rate  # lowered when a tuned link turns out to be unreliable
+        self.error_window_start = 0.0
+        self.error_window_count = 0
+
+        # io state, owned by the I/O thread
+        self.sent_output_mask = None
+        self.changed_total = 0
+        self.edge_total = 0
+        self.in_total = 0  # frames decoded since startup
+        self.out_total = 0  # output messages written since startup
+        self.next_keepalive = 0.0
+        self.keepalive_seconds = self.keepalive_ms / 1000.0  # written by the hal stage
+        self.wake_fd, self.wake_write_fd = os.pipe()  # wakes the I/O thread when the hal outputs change
+        fcntl.fcntl(self.wake_write_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        self.io_thread = None
+
+        # handed between the stages, each is written by one stage only and replaced as a whole
+        self.snapshot = None  # newest InputSnapshot, written by the I/O thread
+        self.output_request = None  # hal output states, written by the hal stage
+
+        # hal stage state
+        self.applied_snapshot = None
+        self.hal_input_mask = None  # the input states last written to hal, None until the first good frame
+        self.next_stats_publish = 0.0
+
+        # reporter state
+        self.next_report = time.time() + REPORT_INTERVAL_SECONDS
+        self.reported_in_total = 0
+        self.reported_out_total = 0
+
+    # ================================================
+    # === CONFIGURE HAL COMPONENT ====================
+    # ================================================
+    def create_component(self, hal):
+        """
+        :param hal: the hal module (or HalShim)
+        """
+        io = hal.component(self.component_name)
+
+        # setup input pins
+        for i in range(self.input_count):
+            # pin names are "component-input-00"
+            #               "component-input-00-not"
+            name = 'input-{:02d}'.format(i)
+            not_name = 'input-{:02d}-not'.format(i)  # configure an inverse pin - this makes it use to test for NOT
+            io.newpin(name, hal.HAL_BIT, hal.HAL_OUT)
+            io.newpin(not_name, hal.HAL_BIT, hal.HAL_OUT)
+            # debounced rising edges, and the time of the last edge in either direction (ns since startup)
+            rise_name = 'input-{:02d}-rise-count'.format(i)
+            edge_name = 'input-{:02d}-last-edge-ns'.format(i)
+            io.newpin(rise_name, hal.HAL_S32, hal.HAL_OUT)
+            io.newpin(edge_name, hal.HAL_FLOAT, hal.HAL_OUT)
+
+            self.input_names[i] = (name, not_name)
+            self.edge_names[i] = (rise_name, edge_name)
+
+        # setup output pins
+        for i in range(self.output_count):
+            name = 'output-{:02d}'.format(i)
+            io.newpin(name, hal.HAL_BIT, hal.HAL_IN)
+
+            self.output_names[i] = name
+
+        # number of input pin state changes seen since startup, wraps like any other hal s32 counter
+        io.newpin('changed-count', hal.HAL_S32, hal.HAL_OUT)
+        self.stats.create_pins(io, hal)
+
+        # how often unchanged outputs are re-sent, can be tuned at runtime with setp
+        io.newparam('output-keepalive-ms', hal.HAL_FLOAT, hal.HAL_RW)
+        io['output-keepalive-ms'] = float(self.keepalive_ms)
+
+        # very important
+        io.ready()
+        self.io = io
+        self.log.debug('hal component {} is ready'.format(self.component_name))
+
+    def fileno(self):
+        return self.port.fileno()
+
+    @property
+    def connected(self):
+        """True while the port is open (initializing or running)"""
+        return self.link_state != LINK_DISCONNECTED
+
+    def next_deadline(self):
+        """the time at which service() next has work to do, None while waiting for a hotplug event"""
+        if self.link_state == LINK_DISCONNECTED:
+            return self.retry_at
+        if self.link_state == LINK_INITIALIZING:
+            return self.connect_time + INITIALIZE_WAIT_SECONDS
+        return self.next_keepalive
+
+    def hotplug_added(self, udev_device):
+        """called from the main thread, hands a matching port to the I/O thread"""
+        if self.link_state != LINK_DISCONNECTED or self.replay_path:
+            return
+        port = match_udev_device(udev_device, self.description, self.serial_number)
+        if port:
+            self.hotplug_port = port
+            self.hotplug_count += 1
+            self.retry_at = 0.0
+            self.wake()
+
+    def wake(self):
+        """interrupt the I/O thread's select(), safe from any thread"""
+        try:
+            os.write(self.wake_write_fd, b'\0')
+        except OSError:
+            pass  # the pipe is full, the I/O thread has a wakeup pending already
+
+    # =============================================
+    # ==== I/O THREAD =============================
+    # =============================================
+    def start_io(self):
+        self.io_thread = threading.Thread(target=self.io_loop, name='{}-io'.format(self.component_name))
+        self.io_thread.daemon = True
+        self.io_thread.start()
+
+    def io_loop(self):
+        """
+        The I/O thread is event driven, it waits in select() on the port (and the wake pipe) until the device has
+        data for us, the hal stage has new outputs, or the next deadline passes.
+        Anything unexpected drops the link and is retried after RECONNECT_WAIT_SECONDS, the thread must not die
+        while the hal stage keeps publishing its last inputs.
+        """
+        while True:
+            try:
+                self.io_step()
+            except Exception:
+                self.log.exception('unexpected error in the I/O thread, reconnecting')
+                self.disconnect()
+                self.retry_at = time.time() + RECONNECT_WAIT_SECONDS
+
+    def io_step(self):
+        self.service(time.time())
+
+        waitables = [self.wake_fd]
+        if self.connected:
+            waitables.append(self.port)
+        deadline = self.next_deadline()
+        wait_seconds = None if deadline is None else max(0.0, deadline - time.time())
+        readable, _, _ = select.select(waitables, [], [], wait_seconds)
+
+        if self.wake_fd in readable:
+            os.read(self.wake_fd, 64)
+        if self.connected and self.port in readable:
+            self.read_ready()
+
+    def disconnect(self):
+        close_port(self.port)
+        self.port = None
+        self.link_state = LINK_DISCONNECTED
+        self.retry_at = 0.0  # try the cached port straight away, discovery backs off if the device is gone
+        self.reported_missing = False
+        self.stats.reset_timing()
 
     # =============================================
     # ==== CONNECT TO ARDUINO DEVICE ==============
     # =============================================
-    if arduino is None:
-        serial_port = discover_port() # if the device isn't found, an exception will be raised here
+    def connect(self, now):
+        if self.replay_path:
+            self.connect_replay(now)
+            return
+
+        hotplug_count = self.hotplug_count
+        serial_port = self.hotplug_port or self.device_port
+        if serial_port is None and self.cached_port is not None and os.path.exists(self.cached_port):
+            serial_port = self.cached_port
+        if serial_port is None:
+            try:
+                serial_port = discover_port(self.description, self.serial_number)
+            except DeviceNotFound as e:
+                if not self.reported_missing:
+                    self.log.warning(str(e))
+                    self.reported_missing = True
+        self.hotplug_port = None
+
         if not serial_port:
-            raise ValueError('no valid serial port found')
+            if not self.hotplug_available:
+                self.retry_at = now + RECONNECT_WAIT_SECONDS
+            elif self.hotplug_count == hotplug_count:
+                # nothing to connect to, wait for udev to tell us a device was added
+                self.retry_at = None
+            else:
+                self.retry_at = now  # a device was added while we were searching
+            return
 
-        log.warning('connecting to Arduino at: "{}"'.format(serial_port))
+        self.log.warning('connecting to Arduino at: "{}"'.format(serial_port))
         try:
 
-            arduino = serial.Serial(port=serial_port,
-                                    baudrate=BAUD_RATE,
-                                    **SERIAL_OPTIONS)
-            if not arduino.is_open:
+            port = serial.Serial(port=serial_port,
+                                 baudrate=BAUD_RATE,
+                                 **SERIAL_OPTIONS)
+            if not port.is_open:
                 raise RuntimeError('port "{}" is not open after opening !?!?!'.format(serial_port))
-
-            # read the first message and throw it away, it will usually be part of a message.
-            arduino.readline()
         except Exception as e:
-            log.exception('failed to connect to device at "{}" - {}'.format(serial_port, e))
-            time.sleep(1)
-            continue
+            self.log.exception('failed to connect to device at "{}" - {}'.format(serial_port, e))
+            if serial_port == self.cached_port:
+                self.cached_port = None  # fall back to discovery on the next attempt
+            self.retry_at = now + RECONNECT_WAIT_SECONDS
+            return
+
+        self.port = port
+        self.cached_port = serial_port
+        self.protocol = None  # negotiated once the device has initialized
+        self.connect_time = now
+        self.link_state = LINK_INITIALIZING
+        if self.connected_once:
+            self.stats.count('reconnects')
+        self.connected_once = True
+
+    def connect_replay(self, now):
+        try:
+            port = ReplayPort(self.replay_path, speed=self.replay_speed)
+        except Exception:
+            self.log.exception('failed to open capture "{}"'.format(self.replay_path))
+            self.retry_at = now + RECONNECT_WAIT_SECONDS
+            return
+        if port.input_count != self.input_count:
+            self.log.warning('capture has {} inputs, configured for {}'.format(port.input_count, self.input_count))
+
+        self.log.warning('replaying capture: "{}"'.format(self.replay_path))
+        self.port = port
+        self.protocol = None
+        # a replay has nothing to initialize, start() is called on the next service()
+        self.connect_time = now - INITIALIZE_WAIT_SECONDS
+        self.link_state = LINK_INITIALIZING
+
+    def attach(self, port, protocol):
+        """
+        Use an already open port that speaks `protocol`, connection setup and negotiation are skipped.
+        Intended for tests and benchmarks, a real device is opened by connect().
+        """
+        self.log.warning('attached to port: "{}"'.format(getattr(port, 'port', port)))
+        self.port = port
+        self.connect_time = time.time()
+        self.link_state = LINK_INITIALIZING
+        self.begin(protocol)
 
-    # Before beginning to read give time for the Arduino to initialize
-    # it's important you don't BLOCK (time.sleep) during this period as it will cause connection issues
-    if time.time() < (start_time + INITIALIZE_WAIT_SECONDS):
-        time.sleep(CPU_SLEEP_SECONDS)
-        continue
+    # =============================================
+    # ==== NEGOTIATE WIRE PROTOCOL ================
+    # =============================================
+    def start(self):
+        """negotiate the protocol and baud rate, called once the device has initialized"""
+        port = self.port
+        if isinstance(port, ReplayPort):
+            # the protocol and baud rate were negotiated when the capture was recorded
+            port.start()
+            self.begin(port.protocol)
+            return
+
+        protocol = PROTOCOL_LEGACY
+        if self.protocol_setting != PROTOCOL_LEGACY:
+            try:
+                protocol = negotiate_protocol(port)
+            except Exception:
+                self.log.exception('failed to negotiate protocol with device')
+                self.disconnect()
+                return
+        if self.protocol_setting == PROTOCOL_FRAMED and protocol != PROTOCOL_FRAMED:
+            self.log.warning('device did not acknowledge the framed protocol, reconnecting')
+            self.disconnect()
+            return
+        self.log.warning('using {} protocol'.format(protocol))
+
+        # the device resets when the port is opened, so every connection starts at BAUD_RATE
+        if protocol == PROTOCOL_FRAMED and self.baud_cap > BAUD_RATE:
+            try:
+                baud, round_trips = tune_baud(port, [rate for rate in BAUD_RATES if rate <= self.baud_cap],
+                                              self.log)
+            except Exception:
+                self.log.exception('failed to tune baud rate')
+                self.disconnect()
+                return
+            if round_trips is not None:
+                self.log.warning('link tuned to {} baud, loopback {:.1f} frames/sec'.format(baud, round_trips))
+        self.begin(protocol)
+
+    def begin(self, protocol):
+        """switch a connected link over to exchanging frames"""
+        port = self.port
+        self.stats.set_gauge('baud-rate', port.baudrate)
+        if self.capture is not None:
+            self.capture.session(protocol, self.input_count, self.output_count, port.baudrate)
+
+        # from here on the port is only read when select() reports data, reads must never block
+        port.timeout = 0
+        # the first bytes are most likely the tail of a frame, the buffer discards everything up to the
+        # first delimiter and is in sync with the device from there on
+        self.frame_buffer = FrameBuffer(FRAME_DELIMITER if protocol == PROTOCOL_FRAMED else LEGACY_DELIMITER,
+                                        synced=False)
+        self.output_encoder = OutputEncoder(self.output_count, protocol)
+        self.protocol = protocol
+        self.sent_output_mask = None
+        self.debouncer.reset()
+        self.next_keepalive = time.time()
+        self.error_window_start = time.time()
+        self.error_window_count = 0
+        self.link_state = LINK_RUNNING
 
     # =============================================
     # ==== HANDLE INPUTS FROM DEVICE ==============
     # =============================================
-    input_error = False
-    try:
-        input_msg = arduino.readline()
-    except Exception:
-        arduino = None
-        log.exception('failed to read input from device')
-        continue
-
-    if warmup_counter > 0:
-        warmup_counter -= 1
-        time.sleep(CPU_SLEEP_SECONDS)
-        continue
-
-    expected_msg_length = INPUT_MSG_PREFIX + INPUT_COUNT + INPUT_MSG_SUFFIX
-    if len(input_msg) < expected_msg_length:
-        log.warning('invalid msg length: {}, expected: {}'.format(len(input_msg), expected_msg_length))
-        continue
-
-    checksum = ord(input_msg[0])  # the device sends a checksum based on what inputs are on
-    num_inputs = ord(input_msg[1])  # the device sends with the input msg the number of configured inputs
+    def read_ready(self):
+        """called by the main loop when select() reports data on the port"""
+        try:
+            input_data = self.port.read(self.port.in_waiting or 1)
+        except EOFError as e:
+            # the end of a replay is final, the inputs keep their last values until the driver is restarted
+            self.log.warning(str(e))
+            self.disconnect()
+            self.retry_at = None
+            return
+        except Exception:
+            self.log.exception('failed to read input from device')
+            self.disconnect()
+            return
+
+        # Before beginning to process input give time for the Arduino to initialize,
+        # anything the device sends while initializing is read and thrown away.
+        if self.link_state != LINK_RUNNING:
+            return
+
+        if self.capture is not None:
+            self.capture.rx(input_data)
+
+        for input_msg in self.frame_buffer.feed(input_data):
+            try:
+                frame_mask = self.decode_input(input_msg)
+            except FrameChecksumError as e:
+                self.stats.count('frames-bad-checksum')
+                self.error_window_count += 1
+                self.errors.error('bad-checksum', '%s', e)
+                continue
+            except FrameError as e:
+                self.stats.count('frames-short')
+                self.error_window_count += 1
+                self.errors.error('bad-frame', '%s', e)
+                continue
 
-    try:
-        input_states = input_msg[INPUT_MSG_PREFIX:-INPUT_MSG_SUFFIX]
-    except IndexError:
-        log.warning('bad input msg, {}')
-        input_error = True
-        input_states = []
-
-    # the device reports to us how many hardware inputs are configured in its current programming
-    # this should match what we expect via configuration, if it doesn't there is a problem.
-    if num_inputs != INPUT_COUNT:
-        log.warning('the configured inputs, and the number supported by the device do not match! %s != %s' % (INPUT_COUNT, num_inputs))
-        input_error = True
-
-    calc_pins_on = sum([1 if char_value == PIN_ON else 0 for char_value in input_states])
-    calc_checksum = sum([CHECKSUM_ON if char_value == PIN_ON else CHECKSUM_OFF for char_value in input_states])
-
-    # ensure the input checksum is sane
-    if checksum != calc_checksum:
-        log.warning('bad checksum: (microcontroller) %s != (calculated) %s' % (checksum, calc_checksum))
-        input_error = True
-
-    inputs_msg_length = len(input_states)
-    if inputs_msg_length != INPUT_COUNT:
-        log.warning('input states msg wrong length, expected: {}, got: {}'.format(INPUT_COUNT, inputs_msg_length))
-        input_error = True
-
-    if not input_error:
-        in_counter += 1
-        for i in range(INPUT_COUNT):
-            # ord() will convert a single byte to an integer
-            # the status of the port are represented with a 1 byte integer or (char)
-            byte_pos = i
-            state = input_states[byte_pos]
-            input_name, input_not_name = INPUT_NAMES[i]
-            # set the pin state based upon the input state the device provided
-            if state == PIN_ON:
-                io[input_name] = True
-                io[input_not_name] = False
-            elif state == PIN_OFF:
-                io[input_name] = False
-                io[input_not_name] = True
+            now = time.time()
+            self.stats.frame_received(now)
+            self.in_total += 1
+            self.publish_snapshot(frame_mask, now)
+
+    def publish_snapshot(self, frame_mask, now):
+        """debounce a decoded frame and hand the result to the hal stage"""
+        debouncer = self.debouncer
+        input_mask = debouncer.update(frame_mask, now)
+        previous = self.snapshot
+        if previous is None or debouncer.edges:
+            if debouncer.edges:
+                self.changed_total += bin(debouncer.edges).count('1')
+                self.edge_total += 1
+            rise_counts = tuple(debouncer.rise_counts)
+            last_edge = tuple(debouncer.last_edge)
+        else:
+            rise_counts = previous.rise_counts
+            last_edge = previous.last_edge
+        self.snapshot = InputSnapshot(frame_mask, input_mask, self.changed_total, self.edge_total, rise_counts,
+                                      last_edge)
+
+    def decode_input(self, input_msg):
+        """
+        Validate an input message, FrameError is raised for invalid messages
+
+        :return: the input bitmask
+        """
+        input_mask, non_binary = decode_input(self.protocol, input_msg, self.input_count, DEFAULT_BIT_PIN_STATE)
+        if non_binary:
+            self.errors.error('non-binary', '%d non binary pin states from controller', non_binary)
+        return input_mask
+
+    def apply_input_mask(self, input_mask, previous_mask=None):
+        """
+        Write the input states to hal, only the pins that differ from `previous_mask` are touched.
+
+        :param input_mask: integer bitmask of the new input states
+        :param previous_mask: bitmask of the states currently held by the hal pins, None writes every pin
+        :return: the number of pins that changed state
+        """
+        if previous_mask is None:
+            changed = (1 << self.input_count) - 1
+        else:
+            changed = input_mask ^ previous_mask
+
+        io = self.io
+        input_names = self.input_names
+        changed_count = 0
+        while changed:
+            low_bit = changed & -changed  # isolate the lowest changed pin
+            changed ^= low_bit
+            state = bool(input_mask & low_bit)
+            input_name, input_not_name = input_names[low_bit.bit_length() - 1]
+            io[input_name] = state
+            io[input_not_name] = not state
+            changed_count += 1
+
+        if previous_mask is None:
+            return 0
+        return changed_count
+
+    def apply_edges(self, snapshot, previous):
+        """
+        Write the edge counters of the pins that had an edge since the `previous` snapshot was applied
+        """
+        io = self.io
+        for pin in range(self.input_count):
+            if previous is not None and snapshot.last_edge[pin] == previous.last_edge[pin]:
+                continue
+            rise_name, edge_name = self.edge_names[pin]
+            io[rise_name] = snapshot.rise_counts[pin] % S32_WRAP
+            last_edge = snapshot.last_edge[pin]
+            # the debouncer starts at 0.0 until the pin has seen an edge, publish 0 instead of a huge negative time
+            io[edge_name] = (last_edge - self.started) * 1e9 if last_edge else 0.0
+
+    def read_output_mask(self):
+        """
+        :return: integer bitmask of the current hal output pin states
+        """
+        io = self.io
+        output_mask = 0
+        for i in range(self.output_count):
+            # set the state of the arduino pin based no the current state of the HAL pin
+            if io[self.output_names[i]]:
+                output_mask |= 1 << i
+        return output_mask
+
+    def set_keepalive(self, keepalive_ms):
+        """
+        Apply a new output-keepalive-ms value, the I/O thread uses it from the next output write on
+
+        :param keepalive_ms: requested interval, clamped to OUTPUT_KEEPALIVE_MIN_SECONDS..OUTPUT_KEEPALIVE_MAX_SECONDS
+        """
+        clamped_ms = min(max(keepalive_ms, OUTPUT_KEEPALIVE_MIN_SECONDS * 1000), OUTPUT_KEEPALIVE_MAX_SECONDS * 1000)
+        if clamped_ms != keepalive_ms:
+            self.log.warning('output-keepalive-ms {:g} out of range, using {:g}'.format(keepalive_ms, clamped_ms))
+            self.io['output-keepalive-ms'] = clamped_ms
+        self.keepalive_ms = clamped_ms
+        self.keepalive_seconds = clamped_ms / 1000.0
+
+    def service(self, now):
+        """run whatever work is due: connection attempts, output writes, statistics and reports"""
+        if self.link_state == LINK_DISCONNECTED:
+            if self.retry_at is not None and now >= self.retry_at:
+                self.connect(now)
+            return
+
+        if self.link_state == LINK_INITIALIZING:
+            if now >= self.connect_time + INITIALIZE_WAIT_SECONDS:
+                self.start()
+            return
+
+        # a tuned link that keeps producing bad frames is reconnected one baud rate lower
+        baud = self.port.baudrate
+        if baud > BAUD_RATE and self.error_window_count >= BAUD_ERROR_LIMIT:
+            lower_rates = [rate for rate in BAUD_RATES if rate < baud]
+            self.baud_cap = max(lower_rates) if lower_rates else BAUD_RATE
+            self.log.warning('{} bad frames at {} baud, reconnecting at {} baud or lower'.format(
+                self.error_window_count, baud, self.baud_cap))
+            self.disconnect()
+            return
+        if now - self.error_window_start >= BAUD_ERROR_WINDOW_SECONDS:
+            self.error_window_start = now
+            self.error_window_count = 0
+
+        # =============================================
+        # ==== SEND OUTPUTS TO DEVICE =================
+        # =============================================
+
+        # changed outputs are sent right away. The device has an internal timeout, if it doesn't hear from us in a
+        # given time it will disable all outputs, so unchanged outputs are re-sent at the keepalive deadline.
+        output_mask = self.output_request
+        if output_mask is None:
+            # the hal stage hasn't read the output pins yet
+            self.next_keepalive = now + HAL_SYNC_SECONDS
+            return
+        if output_mask != self.sent_output_mask or now >= self.next_keepalive:
+            # output_bin is our binary message containing output states sent to the controller,
+            # the encoder hands back the previous message untouched if the outputs haven't changed
+            output_bin = self.output_encoder.encode(output_mask)
+            try:
+                # write the state of each output to the device.
+                self.port.write(output_bin)
+            except SerialTimeoutException as e:
+                self.errors.error('write-timeout', '%s', e)
+                self.port.reset_output_buffer()  # throw away anything we sent to the arduino.
+            except Exception:
+                self.log.exception('failed to write to device')
+                self.disconnect()
+                return
             else:
-                log.warning('non binary pin state from controller: {}'.format(ord(state)))
-                io[input_name] = DEFAULT_BIT_PIN_STATE
-                io[input_not_name] = not DEFAULT_BIT_PIN_STATE
-    else:
-        input_states = '\0'
+                if self.capture is not None:
+                    self.capture.tx(output_bin, now)
+                self.stats.output_written(now)
+                self.out_total += 1
+                self.sent_output_mask = output_mask
+                self.next_keepalive = now + self.keepalive_seconds
 
     # =============================================
-    # ==== SEND OUTPUTS TO DEVICE =================
+    # ==== HAL STAGE ==============================
     # =============================================
+    def sync_hal(self, now):
+        """apply the newest input snapshot to hal and post the hal output states, called from the main thread"""
+        snapshot = self.snapshot
+        previous = self.applied_snapshot
+        if snapshot is not previous:
+            if snapshot.input_mask != self.hal_input_mask:
+                self.apply_input_mask(snapshot.input_mask, self.hal_input_mask)
+                self.hal_input_mask = snapshot.input_mask
+            if previous is None or snapshot.edge_total != previous.edge_total:
+                self.io['changed-count'] = snapshot.changed_total % S32_WRAP
+                self.apply_edges(snapshot, previous)
+            self.applied_snapshot = snapshot
+
+        output_mask = self.read_output_mask()
+        if output_mask != self.output_request:
+            self.output_request = output_mask
+            self.wake()
+
+        keepalive_ms = self.io['output-keepalive-ms']
+        if keepalive_ms != self.keepalive_ms:
+            self.set_keepalive(keepalive_ms)
+
+        if now >= self.next_stats_publish:
+            self.next_stats_publish = now + STATS_PUBLISH_SECONDS
+            self.stats.publish(self.io, now)
 
-    # create empty array of output states, we must update outputs
-    # each iteration regardless if they've changed.
-    # the device has an internal timeout, if it doesn't hear from us in a given time it will disable all
-    # outputs.
-    output_states = [chr(0)] * OUTPUT_COUNT
-    for i in range(OUTPUT_COUNT):
-        output_name = OUTPUT_NAMES[i]
-        # set the state of the arduino pin based no the current state of the HAL pin
-        output_states[i] = chr(int(bool(io[output_name])))
-
-    # output_bin is our binary message containing output states sent to the controller
-    # create a binary string, each character being a 1 byte integer for pin status, terminated with newline [(char) 10]
-    output_bin = ''.join(output_states) + '\n'
-    try:
-        # write the state of each output to the device.
-        arduino.write(output_bin)
-    except SerialTimeoutException as e:
-        log.warning(str(e))
-        arduino.reset_output_buffer()  # throw away anything we sent to the arduino.
-    except Exception:
-        log.exception('failed to write to device')
-        arduino = None
-        continue
-    else:
-        out_counter += 1
-        log.debug('update success')
+    # =============================================
+    # ==== REPORTS ================================
+    # =============================================
+    def report(self, now):
+        """periodically report on inputs and outputs, called from the reporter thread"""
+        if now < self.next_report:
+            return
+        in_total, out_total = self.in_total, self.out_total
+        in_counter = in_total - self.reported_in_total
+        out_counter = out_total - self.reported_out_total
+        msgs_sec = float(in_counter + out_counter) / REPORT_INTERVAL_SECONDS
+        self.errors.summary()
+        if self.log.isEnabledFor(logging.INFO):
+            self.log.info('msg/sec %s - input msgs: %s, output msgs: %s', msgs_sec, in_counter, out_counter)
+            snapshot = self.snapshot
+            if snapshot is not None:
+                self.log.info('input:  %s', format_mask(snapshot.raw_mask, self.input_count))
+            if self.sent_output_mask is not None:
+                self.log.info('output: %s', format_mask(self.sent_output_mask, self.output_count))
+        # reset counters/timer
+        self.next_report = now + REPORT_INTERVAL_SECONDS
+        self.reported_in_total, self.reported_out_total = in_total, out_total
 
-    time.sleep(CPU_SLEEP_SECONDS)
 
-    # periodically report on inputs and outputs
-    if (time.time() - tlast) >= REPORT_INTERVAL_SECONDS:
-        msgs_sec = float(sum((in_counter, out_counter))) / REPORT_INTERVAL_SECONDS
-        log.info('msg/sec {} - input msgs: {}, output msgs: {}'.format(msgs_sec, in_counter, out_counter))
-        log.info('input:  {}'.format(''.join([str(ord(state)) for state in input_states])))
-        log.info('output: {}'.format(''.join([str(ord(state)) for state in output_states])))
-        # reset counters/timer
-        tlast = time.time()
-        in_counter = out_counter = 0
+class Mega2560Driver(object):
+    """
+    Builds the hal components and runs the devices of one configuration.
+
+    Nothing happens on import, the driver is set up in explicit steps:
+        configure()  read the configuration, load hal (HalShim when it isn't available) and create the components
+        connect()    attach ports handed in by the caller, make a first connection attempt for the other devices
+        run()        run the stages on their own threads until the process is stopped (the normal way to run)
+        step()       run one pass of every stage on the calling thread, for tests and benchmarks
+    """
+
+    def __init__(self):
+        self.conf = None
+        self.hal = None
+        self.handler = None  # LogRelay in front of syslog, None when running on HalShim
+        self.devices = []
+        self.connected = False
+
+    def configure(self, conf=None, conf_path=None):
+        """
+        :param conf: configuration dict, read from `conf_path` (see load_config()) when not given
+        :return: self
+        """
+        if conf is None:
+            conf = load_config(conf_path)
+        self.conf = conf
+        devices_conf = conf.get('DEVICES', [conf])
+        if not devices_conf:
+            raise ValueError('DEVICES invalid, at least one device must be configured')
+        if len(set(device_conf['COMPONENT'] for device_conf in devices_conf)) != len(devices_conf):
+            raise ValueError('DEVICES invalid, every device needs a unique COMPONENT')
+
+        try:
+            import hal
+            self.handler = LogRelay(logging.handlers.SysLogHandler(address='/dev/log'))
+        except ImportError:
+            # if HAL isn't available we will provide a simple shim
+            # so the program  can be verified.
+            log.warning('hal unavailable, providing shim layer for debugging')
+            hal = HalShim
+        self.hal = hal
+        self.get_logger(log.name)
+
+        defaults = {
+            'PROTOCOL': conf.get('PROTOCOL', PROTOCOL_LEGACY),
+            'MAX_BAUD_RATE': conf.get('MAX_BAUD_RATE', BAUD_RATE),
+        }
+        for device_conf in devices_conf:
+            merged = dict(defaults)
+            merged.update(device_conf)
+            device = Mega2560Device(merged, self.get_logger(device_conf['COMPONENT']))
+            device.create_component(hal)
+            self.devices.append(device)
+        return self
+
+    def get_logger(self, name):
+        """every device logs under its own component name, all of them share the (relayed) syslog handler"""
+        device_log = logging.getLogger(name)
+        if self.handler is None:
+            device_log.setLevel(logging.INFO)
+        elif self.handler not in device_log.handlers:
+            device_log.addHandler(self.handler)
+            device_log.setLevel(getattr(logging, self.conf['LOG_LEVEL']))
+        return device_log
+
+    def connect(self, ports=None):
+        """
+        :param ports: optional dict of component name to (open port, protocol), these devices use the given port
+                      instead of connecting on their own (see Mega2560Device.attach())
+        """
+        ports = ports or {}
+        now = time.time()
+        for device in self.devices:
+            if device.component_name in ports:
+                device.attach(*ports[device.component_name])
+                continue
+            if serial is None and not device.replay_path:
+                raise ImportError('"pyserial" is not available, install with "python -m pip install pyserial" - '
+                                  '{}'.format(SERIAL_IMPORT_ERROR))
+            device.service(now)
+        self.connected = True
+
+    def step(self, timeout=0.0):
+        """
+        One pass of every stage on the calling thread: connection upkeep and output writes, reading and decoding
+        whatever the ports have (waiting up to `timeout` seconds for data), the hal sync and due reports.
+        """
+        now = time.time()
+        for device in self.devices:
+            device.service(now)
+
+        ports = [device.port for device in self.devices if device.connected]
+        if ports:
+            readable, _, _ = select.select(ports, [], [], timeout)
+            for device in self.devices:
+                if device.connected and device.port in readable:
+                    device.read_ready()
+        elif timeout:
+            time.sleep(timeout)
+
+        now = time.time()
+        for device in self.devices:
+            device.sync_hal(now)
+            device.report(now)
+        if self.handler is not None:
+            self.handler.relay()
+
+    def report_loop(self):
+        """
+        The reporter thread, everything that may be slow (syslog) happens here. Log records from the other threads
+        are queued by LogRelay and handed over to syslog by this thread.
+        """
+        while True:
+            time.sleep(LOG_RELAY_SECONDS)
+            now = time.time()
+            for device in self.devices:
+                device.report(now)
+            if self.handler is not None:
+                self.handler.relay()
+
+    def run(self):
+        """
+        Start an I/O thread per device and the reporter thread, then run the hal stage on the main thread: every
+        HAL_SYNC_SECONDS the newest inputs are applied to hal and output changes are handed to the I/O threads.
+        Between syncs the main thread waits on udev for hotplug events.
+
+        :return: exit status, 1 if an I/O thread died
+        """
+        if not self.connected:
+            self.connect()
+        # the monitor is started before the I/O threads, so a device plugged in from here on is never missed
+        hotplug = HotplugMonitor(logger=log)
+        for device in self.devices:
+            device.hotplug_available = hotplug.available
+            device.start_io()
+        reporter = threading.Thread(target=self.report_loop, name='mega2560-report')
+        reporter.daemon = True
+        reporter.start()
+
+        next_sync = time.time()
+        while True:
+            now = time.time()
+            if now >= next_sync:
+                for device in self.devices:
+                    if not device.io_thread.is_alive():
+                        device.log.critical('I/O thread is gone, exiting')
+                        if self.handler is not None:
+                            self.handler.relay()
+                        return 1
+                    device.sync_hal(now)
+                next_sync += HAL_SYNC_SECONDS
+                if next_sync < now:
+                    next_sync = now + HAL_SYNC_SECONDS  # we overran, skip the missed periods instead of bursting
+
+            wait_seconds = max(0.0, next_sync - time.time())
+            if not hotplug.available:
+                time.sleep(wait_seconds)
+                continue
+            readable, _, _ = select.select([hotplug], [], [], wait_seconds)
+            if readable:
+                for udev_device in hotplug.events():
+                    for device in self.devices:
+                        device.hotplug_added(udev_device)
+
+
+def main(argv=None):
+    if sys.version_info[0] != PYTHON_REQUIRED_VERSION:
+        raise RuntimeError('Invalid python version! ({})\n' \
+            'LinuxCNC is currently only compatible with Python {} \n' \
+            'When LinuxCNC 2.9 is officially released it will support Python 3'.format(PYTHON_MAJOR_VERSION,
+                                                                                       PYTHON_REQUIRED_VERSION))
+
+    driver = Mega2560Driver().configure()
+    return driver.run()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
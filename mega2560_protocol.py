@@ -0,0 +1,648 @@
+"""
+Wire protocol helpers for the mega2560 Digital INPUT/OUTPUT component
+
+Two wire formats are supported:
+
+LEGACY (byte-per-pin)
+    input:  [checksum][input count][state 0]...[state N]\\n
+    output: [state 0]...[state N]\\n
+
+FRAMED (bit-per-pin)
+    Every frame is COBS encoded and terminated with a single 0x00 delimiter, the decoded frame is:
+
+    [length header][packed pin states ...][crc16 hi][crc16 lo]
+
+    The length header is the number of pins described by the frame, pin states are packed 8 per byte with
+    pin 0 in the least significant bit of the first byte. The crc is CRC16-CCITT (poly 0x1021, init 0xFFFF)
+    calculated over the length header and the packed states.
+
+    A length header of 0 marks a control frame, the byte following it is the control code.
+
+    Control codes:
+        CTRL_HELLO_ACK      device -> host  the device switched to the framed protocol
+        CTRL_BAUD_REQUEST   host -> device  [baud u32 big endian] switch to this baud rate
+        CTRL_BAUD_ACK       device -> host  [baud u32] sent at the old rate, the device switches right after it
+        CTRL_BAUD_NAK       device -> host  [baud u32] the rate isn't supported, the device stays where it is
+        CTRL_ECHO           both ways       [payload] the device sends the same frame straight back (loopback test)
+
+    After switching baud rate the device falls back to the rate it was opened with if it doesn't receive a valid
+    frame within BAUD_CONFIRM_SECONDS, so a rate that doesn't work can't strand the link.
+
+    For 34 inputs a framed input message is 9 bytes on the wire (plus the delimiter), compared to 37 bytes for
+    the legacy format.
+
+The host negotiates the framed format when it connects by sending HANDSHAKE_REQUEST, firmware that understands
+the framed format answers with a FRAME_DELIMITER followed by a CTRL_HELLO_ACK control frame and switches over. The
+leading delimiter ends whatever legacy bytes were already on the wire, so they can't merge with the acknowledgement
+into one undecodable frame. Legacy firmware ignores the request (its length never matches an output message) so the
+host falls back to the legacy format when no acknowledgement arrives within the handshake timeout.
+"""
+import time
+import select
+import struct
+
+PROTOCOL_VERSION = 1
+PROTOCOL_LEGACY = 'legacy'
+PROTOCOL_FRAMED = 'framed'
+PROTOCOL_AUTO = 'auto'
+PROTOCOLS = (PROTOCOL_AUTO, PROTOCOL_LEGACY, PROTOCOL_FRAMED)
+
+LEGACY_DELIMITER = b'\n'
+LEGACY_PREFIX = 2  # [checksum][input count] precede the input states of a legacy input message
+PIN_OFF = 1  # these constants are set in the microcontroller
+PIN_ON = 100
+CHECKSUM_ON = 3
+CHECKSUM_OFF = 2
+FRAME_DELIMITER = b'\x00'
+FRAME_OVERHEAD = 3  # length header + crc16
+MAX_PINS = 255  # the length header is a single byte
+
+CONTROL_FRAME = 0  # length header used by control frames
+CTRL_HELLO_ACK = 0x01
+CTRL_BAUD_REQUEST = 0x02
+CTRL_BAUD_ACK = 0x03
+CTRL_BAUD_NAK = 0x04
+CTRL_ECHO = 0x05
+
+# 0xA5 0x5A is not a valid legacy output state, the firmware uses it to detect the framed handshake
+HANDSHAKE_REQUEST = bytearray(b'\xa5\x5aF') + bytearray((PROTOCOL_VERSION,)) + bytearray(LEGACY_DELIMITER)
+HANDSHAKE_TIMEOUT_SECONDS = 0.5
+CONTROL_TIMEOUT_SECONDS = 0.25  # how long to wait for the device to answer a control frame
+BAUD_CONFIRM_SECONDS = 0.5  # the device reverts a baud change that isn't followed by a valid frame in this time
+BAUD_TEST_FRAMES = 32  # loopback frames exchanged to qualify a baud rate
+BAUD_TEST_PAYLOAD = bytearray(range(0, 256, 9))  # includes 0x00 so COBS stuffing is exercised
+
+
+class FrameError(ValueError):
+    pass
+
+
+class FrameLengthError(FrameError):
+    pass
+
+
+class FrameChecksumError(FrameError):
+    pass
+
+
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table.append(crc)
+    return tuple(table)
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(data, crc=0xFFFF):
+    """
+    CRC16-CCITT (poly 0x1021, init 0xFFFF)
+
+    >>> hex(crc16(bytearray(b'123456789')))
+    '0x29b1'
+
+    :param data: bytearray to checksum
+    :param crc: starting value, allows the crc to be calculated over several buffers
+    :return: 16 bit integer
+    """
+    table = CRC16_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+
+def cobs_encode(data):
+    """
+    Consistent Overhead Byte Stuffing, removes every 0x00 from `data` so 0x00 can be used as a frame delimiter.
+
+    The delimiter is NOT appended.
+
+    >>> cobs_encode(bytearray(b'\\x11\\x00\\x22'))
+    bytearray(b'\\x02\\x11\\x02"')
+
+    :param data: bytearray
+    :return: bytearray
+    """
+    out = bytearray(len(data) + len(data) // 254 + 1)
+    return out[:cobs_encode_into(data, out)]
+
+
+def cobs_encode_into(data, out):
+    """
+    Same as cobs_encode() but writes into the pre-allocated bytearray `out`
+
+    :param data: bytearray
+    :param out: bytearray, at least len(data) + len(data) // 254 + 1 long
+    :return: number of bytes written to `out`
+    """
+    code_pos = 0
+    out_pos = 1
+    code = 1
+    for byte in data:
+        if byte == 0:
+            out[code_pos] = code
+            code_pos = out_pos
+            out_pos += 1
+            code = 1
+            continue
+        out[out_pos] = byte
+        out_pos += 1
+        code += 1
+        if code == 0xFF:
+            out[code_pos] = code
+            code_pos = out_pos
+            out_pos += 1
+            code = 1
+    out[code_pos] = code
+    return out_pos
+
+
+def cobs_decode(data):
+    """
+    Reverse of cobs_encode(), `data` must not include the trailing delimiter.
+
+    :param data: bytearray
+    :return: bytearray
+    """
+    out = bytearray()
+    idx = 0
+    length = len(data)
+    while idx < length:
+        code = data[idx]
+        if code == 0:
+            raise FrameError('unexpected zero byte in cobs frame at position {}'.format(idx))
+        end = idx + code
+        if end > length:
+            raise FrameLengthError('cobs block overruns frame, code: {}, remaining: {}'.format(code, length - idx))
+        out.extend(data[idx + 1:end])
+        idx = end
+        if code < 0xFF and idx < length:
+            out.append(0)
+    return out
+
+
+def pack_mask(mask, count):
+    """
+    Pack the low `count` bits of `mask` into bytes, pin 0 is the least significant bit of the first byte.
+
+    :param mask: integer bitmask of pin states
+    :param count: number of pins
+    :return: bytearray
+    """
+    packed = bytearray((count + 7) // 8)
+    for idx in range(len(packed)):
+        packed[idx] = (mask >> (idx * 8)) & 0xFF
+    return packed
+
+
+def unpack_mask(packed):
+    """
+    Reverse of pack_mask()
+
+    :param packed: bytearray
+    :return: integer bitmask
+    """
+    mask = 0
+    for idx, byte in enumerate(packed):
+        mask |= byte << (idx * 8)
+    return mask
+
+
+def encode_frame(mask, count):
+    """
+    Build a framed message, including the trailing delimiter, describing `count` pin states.
+
+    :param mask: integer bitmask of pin states
+    :param count: number of pins
+    :return: bytearray
+    """
+    if not 0 < count <= MAX_PINS:
+        raise FrameLengthError('pin count out of range: {}'.format(count))
+    frame = bytearray((count,)) + pack_mask(mask, count)
+    crc = crc16(frame)
+    frame.append(crc >> 8)
+    frame.append(crc & 0xFF)
+    encoded = cobs_encode(frame)
+    encoded.extend(FRAME_DELIMITER)
+    return encoded
+
+
+def decode_frame(encoded):
+    """
+    Decode and validate a framed message.
+
+    :param encoded: the raw bytes read from the device, with or without the trailing delimiter.
+    :return: tuple (length header, payload bytearray)
+    """
+    encoded = bytearray(encoded)
+    if encoded.endswith(FRAME_DELIMITER):
+        del encoded[-1]
+    frame = cobs_decode(encoded)
+    if len(frame) < FRAME_OVERHEAD:
+        raise FrameLengthError('frame too short: {} bytes'.format(len(frame)))
+
+    crc = (frame[-2] << 8) | frame[-1]
+    calc_crc = crc16(frame[:-2])
+    if crc != calc_crc:
+        raise FrameChecksumError('bad crc: (microcontroller) {:#06x} != (calculated) {:#06x}'.format(crc, calc_crc))
+
+    return frame[0], frame[1:-2]
+
+
+def decode_input_frame(encoded, count):
+    """
+    Decode a framed input message into a bitmask of input states.
+
+    :param encoded: the raw bytes read from the device
+    :param count: the number of inputs we are configured for
+    :return: integer bitmask, bit N is the state of input N
+    """
+    length, payload = decode_frame(encoded)
+    if length != count:
+        raise FrameLengthError('the configured inputs, and the number supported by the device do not match! '
+                               '{} != {}'.format(count, length))
+    if len(payload) != (count + 7) // 8:
+        raise FrameLengthError('input states wrong length, expected: {}, got: {}'.format((count + 7) // 8,
+                                                                                         len(payload)))
+    return unpack_mask(payload)
+
+
+def encode_control(code, payload=b''):
+    """
+    Build a control frame, including the trailing delimiter
+
+    :param code: one of the CTRL_* constants
+    :param payload: bytes following the control code
+    :return: bytearray
+    """
+    frame = bytearray((CONTROL_FRAME, code)) + bytearray(payload)
+    crc = crc16(frame)
+    frame.append(crc >> 8)
+    frame.append(crc & 0xFF)
+    encoded = cobs_encode(frame)
+    encoded.extend(FRAME_DELIMITER)
+    return encoded
+
+
+def read_control(port, codes, timeout=CONTROL_TIMEOUT_SECONDS):
+    """
+    Wait for a control frame with one of the given `codes`, anything else the device sends meanwhile
+    (input frames, legacy messages) is skipped.
+
+    :param port: open serial port
+    :param codes: sequence of CTRL_* constants
+    :param timeout: seconds to wait
+    :return: tuple (code, payload) or None if the device didn't answer in time
+    """
+    buff = FrameBuffer(FRAME_DELIMITER)
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        readable, _, _ = select.select([port], [], [], remaining)
+        if not readable:
+            return None
+        for candidate in buff.feed(port.read(port.in_waiting or 1)):
+            try:
+                length, payload = decode_frame(candidate)
+            except FrameError:
+                continue
+            if length == CONTROL_FRAME and payload and payload[0] in codes:
+                return payload[0], payload[1:]
+
+
+def negotiate_protocol(port, timeout=HANDSHAKE_TIMEOUT_SECONDS):
+    """
+    Ask the device to switch to the framed protocol.
+
+    :param port: open serial port
+    :param timeout: seconds to wait for the acknowledgement
+    :return: PROTOCOL_FRAMED if the device acknowledged the request, otherwise PROTOCOL_LEGACY
+    """
+    port.reset_input_buffer()
+    port.write(HANDSHAKE_REQUEST)
+    # legacy input messages still in flight are skipped by read_control()
+    if read_control(port, (CTRL_HELLO_ACK,), timeout) is not None:
+        return PROTOCOL_FRAMED
+    return PROTOCOL_LEGACY
+
+
+def loopback_test(port, frames=BAUD_TEST_FRAMES, timeout=CONTROL_TIMEOUT_SECONDS):
+    """
+    Exchange `frames` echo frames with the device.
+
+    :return: round trips per second, or None if any frame was lost or corrupted
+    """
+    start = time.time()
+    for idx in range(frames):
+        payload = bytearray((idx & 0xFF,)) + BAUD_TEST_PAYLOAD
+        port.write(encode_control(CTRL_ECHO, payload))
+        reply = read_control(port, (CTRL_ECHO,), timeout)
+        if reply is None or reply[1] != payload:
+            return None
+    return frames / max(time.time() - start, 1e-6)
+
+
+def tune_baud(port, rates, log=None):
+    """
+    Step the link up to the highest baud rate in `rates` that passes a loopback test.
+
+    Rates are tried from the highest down, a rate is only kept if every loopback frame comes back intact. Must be
+    called right after the framed protocol has been negotiated, while the port is still at the rate it was opened
+    with.
+
+    :param port: open serial port, running the framed protocol
+    :param rates: candidate baud rates, rates at or below the current rate are ignored
+    :param log: optional logger
+    :return: tuple (baud rate in use, loopback round trips per second or None if the rate wasn't changed)
+    """
+    base_rate = port.baudrate
+    for rate in sorted(set(rates), reverse=True):
+        if rate <= base_rate:
+            break
+        port.write(encode_control(CTRL_BAUD_REQUEST, struct.pack('>I', rate)))
+        reply = read_control(port, (CTRL_BAUD_ACK, CTRL_BAUD_NAK))
+        if reply is None or reply[0] != CTRL_BAUD_ACK:
+            if log:
+                log.info('device did not accept {} baud'.format(rate))
+            continue
+
+        port.flush()
+        port.baudrate = rate
+        port.reset_input_buffer()
+        round_trips = loopback_test(port)
+        if round_trips is not None:
+            return rate, round_trips
+
+        # the device drops back to the base rate on its own once it stops hearing from us
+        if log:
+            log.warning('loopback test failed at {} baud, stepping down'.format(rate))
+        port.baudrate = base_rate
+        time.sleep(BAUD_CONFIRM_SECONDS)
+        port.reset_input_buffer()
+    return base_rate, None
+
+
+class FrameBuffer(object):
+    """
+    Incremental frame reassembly for a non-blocking byte stream.
+
+    Bytes are fed in as they arrive, complete frames (without the delimiter) are handed back as soon as their
+    delimiter has been received. A trailing partial frame is kept until the rest of it arrives.
+
+    A buffer created with `synced=False` (a fresh connection, or after clear()) throws away everything up to and
+    including the first delimiter, since that is almost always the tail end of a frame.
+
+    >>> buff = FrameBuffer(LEGACY_DELIMITER)
+    >>> buff.feed(b'ab\\ncd')
+    [bytearray(b'ab')]
+    >>> buff.feed(b'e\\n')
+    [bytearray(b'cde')]
+    """
+    MAX_BUFFER = 4096  # a frame is never this long, if no delimiter shows up the stream is garbage
+
+    def __init__(self, delimiter, synced=True):
+        self._delimiter = bytearray(delimiter)
+        self._buff = bytearray()
+        self._synced = synced
+
+    @property
+    def synced(self):
+        """True once a frame boundary has been seen"""
+        return self._synced
+
+    @property
+    def pending(self):
+        """number of bytes buffered that are not part of a complete frame yet"""
+        return len(self._buff)
+
+    def clear(self):
+        del self._buff[:]
+        self._synced = False
+
+    def feed(self, data):
+        """
+        :param data: bytes read from the device
+        :return: list of complete frames, may be empty
+        """
+        buff = self._buff
+        buff.extend(data)
+        frames = []
+        start = 0
+        delimiter = self._delimiter
+        if not self._synced:
+            end = buff.find(delimiter)
+            if end < 0:
+                del buff[:]
+                return frames
+            start = end + 1
+            self._synced = True
+        while True:
+            end = buff.find(delimiter, start)
+            if end < 0:
+                break
+            frames.append(buff[start:end])
+            start = end + 1
+        if start:
+            del buff[:start]
+        if len(buff) > self.MAX_BUFFER:
+            self.clear()
+        return frames
+
+
+def _legacy_state_table(default_state):
+    """
+    256 entry translation table mapping a legacy pin state byte to the ascii digit of its bit value.
+    Anything that isn't PIN_ON or PIN_OFF maps to `default_state`.
+    """
+    table = bytearray(b'1' if default_state else b'0') * 256
+    table[PIN_ON] = ord(b'1')
+    table[PIN_OFF] = ord(b'0')
+    return bytes(table)
+
+
+LEGACY_STATE_TABLES = {False: _legacy_state_table(False), True: _legacy_state_table(True)}
+_PIN_ON_BYTE = bytearray((PIN_ON,))
+_PIN_OFF_BYTE = bytearray((PIN_OFF,))
+
+
+def decode_legacy_input(input_msg, count, default_state=False):
+    """
+    Validate and decode a legacy (byte-per-pin) input message in a single pass.
+
+    The on/off counts come from bytearray.count() and the bitmask from a 256 entry translation table, so no
+    per-pin python code runs.
+
+    >>> decode_legacy_input(bytearray((7, 3, 100, 1, 1)), 3)
+    (1, 1, 7, 0)
+
+    :param input_msg: the message with its newline terminator already removed
+    :param count: the number of inputs we are configured for
+    :param default_state: state given to pins that are neither PIN_ON nor PIN_OFF
+    :return: tuple (input bitmask, number of pins on, checksum, number of non binary pin states)
+    """
+    expected_msg_length = LEGACY_PREFIX + count
+    if len(input_msg) < expected_msg_length:
+        raise FrameLengthError('invalid msg length: {}, expected: {}'.format(len(input_msg), expected_msg_length))
+
+    input_msg = bytearray(input_msg)
+    checksum = input_msg[0]  # the device sends a checksum based on what inputs are on
+    num_inputs = input_msg[1]  # the device sends with the input msg the number of configured inputs
+
+    # the device reports to us how many hardware inputs are configured in its current programming
+    # this should match what we expect via configuration, if it doesn't there is a problem.
+    if num_inputs != count:
+        raise FrameLengthError('the configured inputs, and the number supported by the device do not match! '
+                               '{} != {}'.format(count, num_inputs))
+
+    input_states = input_msg[LEGACY_PREFIX:]
+    if len(input_states) != count:
+        raise FrameLengthError('input states msg wrong length, expected: {}, got: {}'.format(count,
+                                                                                             len(input_states)))
+
+    pins_on = input_states.count(_PIN_ON_BYTE)
+    non_binary = count - pins_on - input_states.count(_PIN_OFF_BYTE)
+    calc_checksum = pins_on * CHECKSUM_ON + (count - pins_on) * CHECKSUM_OFF
+    if checksum != calc_checksum:
+        raise FrameChecksumError('bad checksum: (microcontroller) {} != (calculated) {}'.format(checksum,
+                                                                                                 calc_checksum))
+
+    # pin 0 is the first state byte, reverse so it becomes the least significant digit
+    digits = input_states.translate(LEGACY_STATE_TABLES[bool(default_state)])
+    digits.reverse()
+    return int(bytes(digits), 2), pins_on, checksum, non_binary
+
+
+def decode_input(protocol, input_msg, count, default_state=False):
+    """
+    Validate and decode one input message of either protocol, FrameError is raised for invalid messages
+
+    :param protocol: PROTOCOL_LEGACY or PROTOCOL_FRAMED
+    :param input_msg: the message with its delimiter already removed
+    :param count: the number of inputs we are configured for
+    :param default_state: state given to legacy pins that are neither PIN_ON nor PIN_OFF
+    :return: tuple (input bitmask, number of non binary pin states)
+    """
+    if protocol == PROTOCOL_FRAMED:
+        return decode_input_frame(input_msg, count), 0
+
+    input_mask, pins_on, checksum, non_binary = decode_legacy_input(input_msg, count, default_state)
+    return input_mask, non_binary
+
+
+def encode_legacy_input(mask, count):
+    """
+    Build a legacy input message the way the firmware sends it, for the simulator and the benchmarks.
+
+    >>> encode_legacy_input(0b001, 3) == bytearray((7, 3, 100, 1, 1)) + bytearray(LEGACY_DELIMITER)
+    True
+
+    :param mask: integer bitmask of input states
+    :param count: number of inputs
+    :return: bytearray, including the newline terminator
+    """
+    states = bytearray(PIN_ON if (mask >> idx) & 1 else PIN_OFF for idx in range(count))
+    pins_on = states.count(_PIN_ON_BYTE)
+    checksum = pins_on * CHECKSUM_ON + (count - pins_on) * CHECKSUM_OFF
+    return bytearray((checksum & 0xFF, count)) + states + bytearray(LEGACY_DELIMITER)
+
+
+def encode_legacy_output(mask, count):
+    """
+    Build a legacy output message, one byte (0 or 1) per output terminated with a newline.
+
+    :param mask: integer bitmask of output states
+    :param count: number of outputs
+    :return: bytearray
+    """
+    frame = bytearray((mask >> idx) & 1 for idx in range(count))
+    frame.extend(LEGACY_DELIMITER)
+    return frame
+
+
+class OutputEncoder(object):
+    """
+    Builds output messages in a buffer that is allocated once per connection.
+
+    The message is updated in place, only the bytes of pins that changed are touched for the legacy format and the
+    framed format is re-packed and COBS encoded into the same buffers. The finished message is kept as an immutable
+    `bytes` object, pyserial passes `bytes` straight to the OS, so re-sending unchanged outputs (keepalives)
+    allocates nothing and writes the exact same frame byte-for-byte.
+
+    >>> encoder = OutputEncoder(3, PROTOCOL_LEGACY)
+    >>> encoder.encode(0b101) == b'\\x01\\x00\\x01\\n'
+    True
+    >>> encoder.encode(0b101) is encoder.encode(0b101)
+    True
+    """
+
+    def __init__(self, count, protocol):
+        if protocol not in (PROTOCOL_LEGACY, PROTOCOL_FRAMED):
+            raise ValueError('unsupported protocol: {}'.format(protocol))
+        self._count = count
+        self._protocol = protocol
+        self._mask = None
+        self._encoded = None
+        if protocol == PROTOCOL_LEGACY:
+            self._frame = bytearray(count) + bytearray(LEGACY_DELIMITER)
+        else:
+            if not 0 < count <= MAX_PINS:
+                raise FrameLengthError('pin count out of range: {}'.format(count))
+            self._frame = bytearray(1 + (count + 7) // 8 + 2)
+            self._frame[0] = count
+            # COBS adds one code byte per 254 bytes of data plus the leading code byte, then the delimiter
+            self._cobs = bytearray(len(self._frame) + len(self._frame) // 254 + 2)
+            self._cobs_view = memoryview(self._cobs)
+
+    @property
+    def mask(self):
+        """the output bitmask of the most recent message, None before the first call to encode()"""
+        return self._mask
+
+    def encode(self, mask):
+        """
+        :param mask: integer bitmask of output states
+        :return: bytes, the complete message including its delimiter
+        """
+        if mask == self._mask:
+            return self._encoded
+
+        frame = self._frame
+        if self._protocol == PROTOCOL_LEGACY:
+            changed = mask ^ self._mask if self._mask is not None else (1 << self._count) - 1
+            while changed:
+                low_bit = changed & -changed
+                changed ^= low_bit
+                frame[low_bit.bit_length() - 1] = 1 if mask & low_bit else 0
+            self._encoded = bytes(frame)
+        else:
+            payload_end = len(frame) - 2
+            for idx in range(1, payload_end):
+                frame[idx] = (mask >> ((idx - 1) * 8)) & 0xFF
+            crc = crc16(frame[:payload_end])
+            frame[payload_end] = crc >> 8
+            frame[payload_end + 1] = crc & 0xFF
+            length = cobs_encode_into(frame, self._cobs)
+            self._cobs[length] = 0
+            self._encoded = self._cobs_view[:length + 1].tobytes()
+
+        self._mask = mask
+        return self._encoded
+
+
+def format_mask(mask, count):
+    """
+    Render a bitmask as a string of 0/1 in pin order (pin 0 first), used for status reports.
+
+    >>> format_mask(0b101, 4)
+    '1010'
+    """
+    return ''.join('1' if (mask >> idx) & 1 else '0' for idx in range(count))
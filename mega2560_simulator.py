@@ -0,0 +1,287 @@
+"""
+Arduino mega2560 simulator
+
+Opens a pseudo terminal and speaks the same wire format as the mega2560 firmware (see mega2560_protocol.py), so
+mega2560_hal_io_pins.py can be run, load tested and benchmarked without hardware. Point a device at the simulator
+with DEVICE_PORT in mega2560_hal_io_config.json, with HAL unavailable the driver runs on HalShim.
+
+The simulated firmware:
+    - sends an input message every 1 / --frame-rate seconds
+    - toggles --toggle-rate random inputs per second
+    - answers the framed handshake, baud rate requests and echo frames (unless --protocol legacy)
+    - corrupts a message (flipped bit or dropped byte) with probability --corrupt
+    - paces every write at the simulated baud rate, 10 bit times per byte (--baud 0 disables pacing)
+    - with --loopback, mirrors the outputs it receives onto the first inputs
+    - turns its outputs off when it doesn't hear from the host for --watchdog seconds
+    - resets (legacy protocol, initial baud rate, outputs off) when the framed handshake arrives while it is
+      framed, that only happens after the host reopened the port, which resets a real mega
+
+Usage:
+    python mega2560_simulator.py [--link /tmp/mega2560] [--protocol framed] [--toggle-rate 5] [--corrupt 0.01]
+"""
+from __future__ import print_function
+import os
+import pty
+import sys
+import time
+import tty
+import random
+import select
+import struct
+import argparse
+
+from mega2560_protocol import PROTOCOL_LEGACY, PROTOCOL_FRAMED, LEGACY_DELIMITER, FRAME_DELIMITER, CONTROL_FRAME, \
+    CTRL_HELLO_ACK, CTRL_BAUD_REQUEST, CTRL_BAUD_ACK, CTRL_BAUD_NAK, CTRL_ECHO, HANDSHAKE_REQUEST, \
+    BAUD_CONFIRM_SECONDS, FrameBuffer, FrameError, decode_frame, encode_control, encode_frame, encode_legacy_input, \
+    unpack_mask
+
+BAUD_RATE = 9600  # rate the firmware starts at
+BITS_PER_BYTE = 10  # 8N1, start + 8 data + stop
+FRAME_RATE = 100.0  # input messages per second
+WATCHDOG_SECONDS = 0.5  # outputs are turned off if the host is silent this long
+
+
+class Mega2560Simulator(object):
+    """
+    A simulated mega2560 on the master side of a pty, `port` is the slave device the driver opens.
+    """
+
+    def __init__(self, input_count=34, output_count=18, protocol=PROTOCOL_FRAMED, frame_rate=FRAME_RATE,
+                 toggle_rate=0.0, corrupt=0.0, baud=BAUD_RATE, max_baud=115200, loopback=False,
+                 watchdog=WATCHDOG_SECONDS, seed=None):
+        """
+        :param protocol: the newest protocol the firmware understands, PROTOCOL_LEGACY ignores the handshake
+        :param baud: rate the link starts at, 0 disables pacing
+        :param max_baud: baud requests above this rate are refused
+        """
+        self.input_count = input_count
+        self.output_count = output_count
+        self.supports_framed = protocol == PROTOCOL_FRAMED
+        self.frame_interval = 1.0 / frame_rate
+        self.toggle_rate = toggle_rate
+        self.corrupt = corrupt
+        self.baud = self.base_baud = baud
+        self.max_baud = max_baud
+        self.loopback = loopback
+        self.watchdog = watchdog
+        self.random = random.Random(seed)
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)  # the slave stays open so the master never sees EIO while the driver reconnects
+        self.port = os.ttyname(self.slave)
+
+        self.framed = False
+        self.input_mask = 0
+        self.output_mask = 0
+        self.toggle_credit = 0.0
+        self.line_free_at = 0.0  # when the simulated wire has finished sending everything written so far
+        self.last_host_frame = 0.0
+        self.baud_confirm_at = None  # a baud change is reverted unless a valid frame arrives before this time
+        self.legacy_buffer = FrameBuffer(LEGACY_DELIMITER)
+        self.framed_buffer = FrameBuffer(FRAME_DELIMITER)
+        self.handshake_tail = bytearray()  # the last bytes received while framed, a handshake may span two reads
+        self.stats = {'frames-sent': 0, 'frames-corrupted': 0, 'outputs-received': 0, 'bad-outputs': 0,
+                      'control-frames': 0, 'watchdog-trips': 0, 'resets': 0}
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+    def reset(self):
+        """
+        What opening the port does to a real mega: the firmware restarts in the legacy protocol at the initial
+        baud rate, with its outputs off
+        """
+        self.framed = False
+        self.baud = self.base_baud
+        self.baud_confirm_at = None
+        self.legacy_buffer = FrameBuffer(LEGACY_DELIMITER)
+        self.framed_buffer = FrameBuffer(FRAME_DELIMITER)
+        self.handshake_tail = bytearray()
+        self.set_outputs(0)
+        self.stats['resets'] += 1
+
+    # === HOST -> DEVICE ===========================
+    def receive(self, data, now):
+        if self.framed:
+            # a handshake while framed means the host reopened the port, the real board would have reset
+            received = self.handshake_tail + data
+            start = received.find(HANDSHAKE_REQUEST)
+            if start < 0:
+                self.handshake_tail = received[-(len(HANDSHAKE_REQUEST) - 1):]
+                for frame in self.framed_buffer.feed(data):
+                    self.receive_frame(frame, now)
+                return
+            self.reset()
+            data = received[start:]
+
+        for line in self.legacy_buffer.feed(data):
+            if self.supports_framed and line + bytearray(LEGACY_DELIMITER) == HANDSHAKE_REQUEST:
+                self.framed = True
+                self.framed_buffer = FrameBuffer(FRAME_DELIMITER)
+                self.send(bytearray(FRAME_DELIMITER) + encode_control(CTRL_HELLO_ACK), now)
+                continue
+            if len(line) != self.output_count or any(state > 1 for state in line):
+                self.stats['bad-outputs'] += 1
+                continue
+            self.output_received(sum(1 << idx for idx, state in enumerate(line) if state), now)
+
+    def receive_frame(self, frame, now):
+        try:
+            length, payload = decode_frame(frame)
+        except FrameError:
+            self.stats['bad-outputs'] += 1
+            return
+        self.baud_confirm_at = None
+        self.last_host_frame = now
+
+        if length != CONTROL_FRAME:
+            if length != self.output_count:
+                self.stats['bad-outputs'] += 1
+                return
+            self.output_received(unpack_mask(payload), now)
+            return
+
+        self.stats['control-frames'] += 1
+        code, payload = payload[0], payload[1:]
+        if code == CTRL_ECHO:
+            self.send(encode_control(CTRL_ECHO, payload), now)
+        elif code == CTRL_BAUD_REQUEST:
+            rate = struct.unpack('>I', bytes(payload))[0]
+            if self.max_baud and rate > self.max_baud:
+                self.send(encode_control(CTRL_BAUD_NAK, payload), now)
+                return
+            # the ack goes out at the old rate, then the firmware switches
+            self.send(encode_control(CTRL_BAUD_ACK, payload), now)
+            if self.baud:
+                self.baud = rate
+            self.baud_confirm_at = self.line_free_at + BAUD_CONFIRM_SECONDS
+
+    def output_received(self, mask, now):
+        self.stats['outputs-received'] += 1
+        self.last_host_frame = now
+        self.set_outputs(mask)
+
+    def set_outputs(self, mask):
+        self.output_mask = mask
+        if self.loopback:
+            count = min(self.input_count, self.output_count)
+            low_pins = (1 << count) - 1
+            self.input_mask = (self.input_mask & ~low_pins) | (mask & low_pins)
+
+    # === DEVICE -> HOST ===========================
+    def input_message(self):
+        if self.framed:
+            return encode_frame(self.input_mask, self.input_count)
+        return encode_legacy_input(self.input_mask, self.input_count)
+
+    def corrupt_message(self, msg):
+        msg = bytearray(msg)
+        idx = self.random.randrange(len(msg) - 1)  # leave the delimiter alone so the host can resync
+        if self.random.random() < 0.5:
+            msg[idx] ^= 1 << self.random.randrange(8)
+        else:
+            del msg[idx]
+        self.stats['frames-corrupted'] += 1
+        return msg
+
+    def send(self, data, now):
+        """write to the host once the simulated wire has finished transmitting `data`"""
+        if self.baud:
+            self.line_free_at = max(now, self.line_free_at) + len(data) * BITS_PER_BYTE / float(self.baud)
+            delay = self.line_free_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        os.write(self.master, bytes(data))
+
+    def tick(self, now):
+        """send one input message, after applying the scheduled input changes"""
+        self.toggle_credit += self.toggle_rate * self.frame_interval
+        while self.toggle_credit >= 1.0:
+            self.toggle_credit -= 1.0
+            self.input_mask ^= 1 << self.random.randrange(self.input_count)
+
+        msg = self.input_message()
+        if self.corrupt and self.random.random() < self.corrupt:
+            msg = self.corrupt_message(msg)
+        self.send(msg, now)
+        self.stats['frames-sent'] += 1
+
+    def check_timers(self, now):
+        if self.baud_confirm_at is not None and now >= self.baud_confirm_at:
+            # the host never confirmed the new rate, fall back so the link can't be stranded
+            self.baud = self.base_baud
+            self.baud_confirm_at = None
+        if self.output_mask and self.watchdog and now - self.last_host_frame > self.watchdog:
+            self.stats['watchdog-trips'] += 1
+            self.set_outputs(0)
+
+    def run(self, duration=None):
+        """
+        Serve the host until `duration` seconds have passed (forever if None)
+        """
+        started = now = time.time()
+        next_frame = now
+        while duration is None or now - started < duration:
+            readable, _, _ = select.select([self.master], [], [], max(0.0, next_frame - now))
+            now = time.time()
+            if readable:
+                try:
+                    data = os.read(self.master, 1024)
+                except OSError:
+                    data = b''  # nothing has the slave open
+                self.receive(bytearray(data), now)
+
+            self.check_timers(now)
+            if now >= next_frame:
+                self.tick(now)
+                next_frame += self.frame_interval
+                if next_frame < now:
+                    next_frame = now + self.frame_interval  # the host stalled us, don't send a burst
+            now = time.time()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--inputs', type=int, default=34, help='INPUT_COUNT of the simulated firmware')
+    parser.add_argument('--outputs', type=int, default=18, help='OUTPUT_COUNT of the simulated firmware')
+    parser.add_argument('--protocol', choices=(PROTOCOL_LEGACY, PROTOCOL_FRAMED), default=PROTOCOL_FRAMED)
+    parser.add_argument('--frame-rate', type=float, default=FRAME_RATE, help='input messages per second')
+    parser.add_argument('--toggle-rate', type=float, default=0.0, help='input changes per second')
+    parser.add_argument('--corrupt', type=float, default=0.0, help='probability a message is corrupted')
+    parser.add_argument('--baud', type=int, default=BAUD_RATE, help='initial baud rate, 0 disables pacing')
+    parser.add_argument('--max-baud', type=int, default=115200, help='refuse baud requests above this rate')
+    parser.add_argument('--loopback', action='store_true', help='mirror outputs onto the first inputs')
+    parser.add_argument('--watchdog', type=float, default=WATCHDOG_SECONDS, help='0 disables the watchdog')
+    parser.add_argument('--duration', type=float, help='seconds to run, forever by default')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--link', help='create a symlink to the pty, e.g. /tmp/mega2560')
+    args = parser.parse_args(argv)
+
+    sim = Mega2560Simulator(input_count=args.inputs, output_count=args.outputs, protocol=args.protocol,
+                            frame_rate=args.frame_rate, toggle_rate=args.toggle_rate, corrupt=args.corrupt,
+                            baud=args.baud, max_baud=args.max_baud, loopback=args.loopback,
+                            watchdog=args.watchdog, seed=args.seed)
+    port = sim.port
+    if args.link:
+        if os.path.islink(args.link):
+            os.unlink(args.link)
+        os.symlink(sim.port, args.link)
+        port = '{} -> {}'.format(args.link, sim.port)
+    print('simulating mega2560 at {}'.format(port))
+    sys.stdout.flush()
+
+    try:
+        sim.run(args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.link and os.path.islink(args.link):
+            os.unlink(args.link)
+        sim.close()
+    print(', '.join('{}: {}'.format(name, value) for name, value in sorted(sim.stats.items())))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+"""
+Record raw XHC pendant HID reports
+
+A capture starts with CAPTURE_MAGIC followed by one record per report:
+
+    [timestamp u64 little endian, nanoseconds since the epoch][length u8][length bytes of report]
+
+Reports are stored exactly as they were read, so a capture can be replayed through decode_report() offline, see
+benchmarks/bench_pendant_decode.py.
+
+Usage:
+    python3 pendant_capture.py record capture.bin [--duration 60]
+    python3 pendant_capture.py info capture.bin
+
+record needs the pendant and stops with Ctrl-C (or after --duration seconds), the pendant_io.py component must not
+be running at the same time.
+"""
+import sys
+import time
+import struct
+import argparse
+
+CAPTURE_MAGIC = b'PENDCAP\x01'  # file signature + format version
+RECORD_HEADER = struct.Struct('<QB')
+
+
+class CaptureError(ValueError):
+    pass
+
+
+class ReportWriter(object):
+    """
+    Appends reports to a capture file, every report is flushed so a capture survives the process being killed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, 'ab')
+        if self._fp.tell() == 0:
+            self._fp.write(CAPTURE_MAGIC)
+        self.count = 0
+
+    def report(self, timestamp, data):
+        data = bytes(data)
+        self._fp.write(RECORD_HEADER.pack(int(timestamp * 1e9), len(data)))
+        self._fp.write(data)
+        self._fp.flush()
+        self.count += 1
+
+    def close(self):
+        self._fp.close()
+
+
+def read_reports(fp):
+    """
+    :param fp: file object opened in binary mode
+    :return: generator of (timestamp seconds, report bytes) tuples, a report cut short by the end of the file is
+             dropped
+    """
+    if fp.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+        raise CaptureError('not a pendant capture (or an unsupported version): {}'.format(getattr(fp, 'name', fp)))
+
+    while True:
+        header = fp.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        timestamp, length = RECORD_HEADER.unpack(header)
+        data = fp.read(length)
+        if len(data) < length:
+            return
+        yield timestamp / 1e9, data
+
+
+def load_reports(path):
+    """
+    :return: list of (timestamp, report bytearray) in the order they were recorded
+    """
+    with open(path, 'rb') as fp:
+        return [(timestamp, bytearray(data)) for timestamp, data in read_reports(fp)]
+
+
+def record(path, duration=None):
+    """
+    Record the reports of the first pendant found until interrupted (or `duration` seconds have passed)
+
+    :return: the number of reports recorded
+    """
+    import pendant_io
+
+    reader = pendant_io.open_reader()
+    if reader is None:
+        raise pendant_io.PendantFault('no pendant found')
+    writer = ReportWriter(path)
+    started = time.time()
+    try:
+        while duration is None or time.time() - started < duration:
+            for timestamp, data in reader.read():
+                writer.report(timestamp, data)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+        reader.close()
+    return writer.count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=('record', 'info'))
+    parser.add_argument('capture', help='capture file, record appends to it')
+    parser.add_argument('--duration', type=float, help='seconds to record, until Ctrl-C by default')
+    args = parser.parse_args(argv)
+
+    if args.command == 'record':
+        print('recording pendant reports to {}, Ctrl-C to stop'.format(args.capture))
+        count = record(args.capture, args.duration)
+        print('{} reports recorded'.format(count))
+        return 0
+
+    from pendant_io import ENC_BYTE
+
+    reports = load_reports(args.capture)
+    duration = reports[-1][0] - reports[0][0] if reports else 0.0
+    mpg_reports = sum(1 for _, data in reports if len(data) > ENC_BYTE and data[ENC_BYTE])
+    print('{} reports over {:.1f}s, {} with MPG counts, {:.0f} reports/s'.format(
+        len(reports), duration, mpg_reports, len(reports) / duration if duration else 0.0))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,96 @@
 """
 Pendant Control IO for LinuxCNC
 
-USB Integration driver for XHC-HB04 (4 axis pendant)
+USB Integration driver for XHC pendants (see PROFILES: HB04, WHB04B-4, WHB04B-6), runs as a HAL component:
+    loadusr -Wn pendant ./pendant_io.py
+
+Several pendants are served by one process, every argument is a hal prefix, optionally bound to the usb serial
+number of one pendant (unbound prefixes take any pendant that is free):
+    loadusr -Wn pendant ./pendant_io.py pendant=0123456 pendant2=0654321
+
+The profile of a prefix is picked when it is created: the profile cached for its serial number in
+PROFILE_CACHE_NAME, or the profile of the pendant connected at startup, DEFAULT_PROFILE without either. A prefix
+connects to pendants of its profile, or of a compatible one (WHB04B-4 and -6 only differ in their axes), any other
+pendant is left alone with a warning.
+
+Pins (prefix "pendant."):
+    button.<name>       (bit out) one per button of the profile, e.g. button.feed-plus, button.macro1
+    mpg-count           (s32 out) accumulated MPG encoder counts, wraps like any s32 counter
+    mpg-accel-count     (s32 out) MPG counts scaled by the acceleration curve, for axis.N.jog-counts
+    mpg-velocity        (float out) smoothed MPG wheel velocity, counts per second
+    jog-velocity        (float out) resulting jog velocity, mpg-velocity * acceleration * jog-increment
+    axis-select         (s32 out) selected axis, see AXIS_SELECT: 0 off, 1 x, 2 y, 3 z, 4 a, 5 b, 6 c
+    axis.<x|y|z|a|b|c>  (bit out) true while that axis is selected, for the axes of the profile
+    jog-speed           (float out) speed selector position as a fraction, 0.02 .. 1.0, 0 in lead mode
+    jog-increment       (float out) jog-speed * jog-scale
+    lead                (bit out) speed selector is in lead mode
+    connected           (bit out) a pendant is connected
+    display.<x|y|z>     (float in) work positions shown on the display
+    display.feedrate    (float in) feed rate shown on the display
+    display.spindle-speed (float in) spindle speed shown on the display
+    jog-scale           (float rw parameter) machine units per MPG count at 100%, 1.0 by default
+    mpg-accel-threshold (float rw parameter) wheel velocity (counts/s) up to which counts are not scaled
+    mpg-accel-range     (float rw parameter) counts/s above the threshold at which the full scale is reached
+    mpg-accel-max       (float rw parameter) largest count multiplier, 1.0 disables acceleration
+
+Reports are read with libusb asynchronous interrupt transfers when python-libusb1 is installed, several transfers
+stay queued so no report is lost while the rest of the loop runs. Without it pyusb's synchronous reads are used.
+
+To install dependencies:
+    python3 -m pip install libusb1
+    python3 -m pip install pyusb
+    python3 -m pip install pyudev
 """
 
 import sys
 import time
-import usb.core
+import math
+import errno
+import json
+import select
 import ctypes
+import logging
+import threading
+import os
+from os.path import join, dirname, expanduser
+from collections import deque, namedtuple
+logging.basicConfig()
+from hal_common import HalShim, HotplugMonitor, wrap_s32
+try:
+    import usb1
+except ImportError:
+    usb1 = None  # optional, AsyncPendantReader needs it
+try:
+    import usb.core
+except ImportError:
+    usb = None  # only needed when usb1 isn't available
 
 VENDOR_ID = 0x10ce
 PRODUCT_ID = 0xeb93
+INTERFACE = 0
+TRANSFER_COUNT = 4  # interrupt transfers kept in flight, a report is only lost if all of them are waiting on us
+REPORT_QUEUE_SIZE = 256  # reports waiting to be decoded, the oldest are dropped (and counted) beyond this
+READ_TIMEOUT_SECONDS = 0.1  # longest a read waits for a report, an idle pendant sends nothing
+RECONNECT_WAIT_SECONDS = 1.0  # retry interval when a pendant couldn't be opened, or without udev hotplug events
+REPORT_INTERVAL_SECONDS = 10.0  # reader statistics are logged this often at INFO
+HOST_CHECK_SECONDS = 1.0  # how often the main thread checks that every PendantHost thread is still running
+LIBUSB_ERROR_TIMEOUT = -7
+DISPLAY_REFRESH_SECONDS = 0.1  # the display is refreshed at most this often
+DISPLAY_REPORT_ID = 0x06  # feature report the display packet is sent with
+DISPLAY_CHUNK_SIZE = 7  # bytes of the display packet per feature report
+DISPLAY_CHUNKS = 3  # feature reports per display packet, the rest of Whb04b_struct is padding
+DISPLAY_TIMEOUT_MS = 100  # a display write that takes longer is a fault
+MPG_SAMPLES = 32  # timestamped MPG reports kept for the velocity estimate, must cover MPG_WINDOW_SECONDS
+MPG_WINDOW_SECONDS = 0.1  # MPG velocity is measured over this window
+MPG_SMOOTHING_SECONDS = 0.05  # time constant of the smoothed MPG velocity
+MPG_ACCEL_THRESHOLD = 20.0  # counts/s, slower turns move exactly one jog increment per count
+MPG_ACCEL_RANGE = 200.0  # counts/s above the threshold where the multiplier reaches MPG_ACCEL_MAX
+MPG_ACCEL_MAX = 10.0  # largest multiplier applied to MPG counts, the curve is quadratic up to it
+COMPONENT_NAME = 'pendant'
+PROFILE_CACHE_NAME = 'pendant_profiles.json'  # usb serial number -> profile name, in PROFILE_CACHE_DIR
+PROFILE_CACHE_DIR = join(os.environ.get('XDG_CACHE_HOME') or expanduser('~/.cache'), 'pendant_io')
+DEFAULT_PROFILE = 'whb04b-4'  # used for a prefix when no pendant is connected at startup
+DISPLAY_PINS = ('display.x', 'display.y', 'display.z', 'display.feedrate', 'display.spindle-speed')
 
 AXS_BYTE = 5
 AXS_MAP = {
@@ -20,6 +100,8 @@ AXS_MAP = {
     19: 'z',
     20: 'a',
 }
+AXIS_SELECT = {'off': 0, 'x': 1, 'y': 2, 'z': 3, 'a': 4, 'b': 5, 'c': 6}  # value of the axis-select pin,
+                                                                          # unknown positions are 0
 
 SPD_BYTE = 4
 SPD_MAP = {
@@ -32,6 +114,15 @@ SPD_MAP = {
     28: 'lead',
 }
 SPD_DEFAULT = 0.0
+JOG_SPEED = {
+    '2%': 0.02,
+    '5%': 0.05,
+    '10%': 0.1,
+    '30%': 0.3,
+    '60%': 0.6,
+    '100%': 1.0,
+    'lead': 0.0,
+}
 
 BTN_BYTE = 2
 BTN2_BYTE = 3
@@ -75,118 +166,953 @@ MACRO_MAP = {
 
 ENC_BYTE = 6
 
+# the WHB04B-6 is the WHB04B-4 with two more axes on the selector
+AXS_MAP_6 = dict(AXS_MAP)
+AXS_MAP_6.update({
+    21: 'b',
+    22: 'c',
+})
+
+# wired XHC-HB04: no speed selector and no function button, codes as in LinuxCNC's xhc-hb04 layout 2
+HB04_PRODUCT_ID = 0xeb70
+HB04_BTN_BYTE = 1
+HB04_BTN2_BYTE = 2
+HB04_AXS_BYTE = 3
+HB04_ENC_BYTE = 4
+HB04_AXS_MAP = {
+    0x00: 'off',
+    0x11: 'x',
+    0x12: 'y',
+    0x13: 'z',
+    0x18: 'a',
+    0x14: 'spindle',
+    0x15: 'feed',
+}
+HB04_BTN_MAP = {
+    0x17: 'reset',
+    0x16: 'stop',
+    0x01: 'goto_zero',
+    0x02: 'start_pause',
+    0x03: 'rewind',
+    0x04: 'probe_z',
+    0x0c: 'spindle',
+    0x06: 'half',
+    0x07: 'zero',
+    0x08: 'safe_z',
+    0x09: 'home',
+    0x0a: 'macro1',
+    0x0b: 'macro2',
+    0x05: 'macro3',
+    0x0d: 'step',
+    0x0e: 'mode',
+    0x0f: 'macro6',
+    0x10: 'macro7',
+}
+
 AXIS_KEY = 'axis'
 SPEED_KEY = 'speed'
 MPG_KEY = 'mpg'
 
+# ==== DEVICE PROFILES =============
+PendantProfile = namedtuple('PendantProfile', (
+    'name',
+    'vendor_id',
+    'product_id',
+    'product_match',  # picks between profiles sharing usb ids, matched against the usb product string
+    'btn_byte',
+    'btn2_byte',
+    'spd_byte',  # None without a speed selector
+    'axs_byte',
+    'enc_byte',
+    'btn_map',  # buttons with the function button held (or all buttons without one)
+    'macro_map',  # buttons without the function button held
+    'axs_map',
+    'spd_map',
+))
+PROFILES = dict((profile.name, profile) for profile in (
+    PendantProfile('whb04b-4', VENDOR_ID, PRODUCT_ID, 'WHB04B-4', BTN_BYTE, BTN2_BYTE, SPD_BYTE, AXS_BYTE, ENC_BYTE,
+                   BTN_MAP, MACRO_MAP, AXS_MAP, SPD_MAP),
+    PendantProfile('whb04b-6', VENDOR_ID, PRODUCT_ID, 'WHB04B-6', BTN_BYTE, BTN2_BYTE, SPD_BYTE, AXS_BYTE, ENC_BYTE,
+                   BTN_MAP, MACRO_MAP, AXS_MAP_6, SPD_MAP),
+    PendantProfile('hb04', VENDOR_ID, HB04_PRODUCT_ID, None, HB04_BTN_BYTE, HB04_BTN2_BYTE, None, HB04_AXS_BYTE,
+                   HB04_ENC_BYTE, HB04_BTN_MAP, HB04_BTN_MAP, HB04_AXS_MAP, {}),
+))
 
-def main(argv=None):
-    while True:
-        print('\r... searching for pendant', end='')
-        pendant = find_device()
-        if pendant is None:
-            time.sleep(1)
+
+log = logging.getLogger('pendant')
+log.setLevel(logging.INFO)
+
+
+def button_pin_name(button):
+    """
+    :return: the hal pin name of a BTN_MAP / MACRO_MAP entry, e.g. "feed+" -> "button.feed-plus"
+    """
+    if button.endswith('+'):
+        button = button[:-1] + '-plus'
+    elif button.endswith('-'):
+        button = button[:-1] + '-minus'
+    return 'button.' + button.replace('_', '-')
+
+
+class PendantComponent(object):
+    """
+    The hal side of the pendant, pins are only written when their value changes.
+    """
+
+    def __init__(self, hal, name=COMPONENT_NAME, decoder=None):
+        """
+        :param hal: the hal module (or HalShim)
+        :param name: hal prefix
+        :param decoder: PendantDecoder of the pendant profile, the button and axis pins follow it
+        """
+        io = hal.component(name)
+        self.name = name
+        self.decoder = decoder or DEFAULT_DECODER
+        self.button_pins = {}  # map button name (as returned by read_data) to hal pin name
+        for button in self.decoder.controls:
+            self.button_pins[button] = button_pin_name(button)
+            io.newpin(self.button_pins[button], hal.HAL_BIT, hal.HAL_OUT)
+        self.axis_pins = dict((axis, 'axis.' + axis) for axis in self.decoder.axes)
+        for pin in self.axis_pins.values():
+            io.newpin(pin, hal.HAL_BIT, hal.HAL_OUT)
+        io.newpin('mpg-count', hal.HAL_S32, hal.HAL_OUT)
+        io.newpin('mpg-accel-count', hal.HAL_S32, hal.HAL_OUT)
+        io.newpin('mpg-velocity', hal.HAL_FLOAT, hal.HAL_OUT)
+        io.newpin('jog-velocity', hal.HAL_FLOAT, hal.HAL_OUT)
+        io.newpin('axis-select', hal.HAL_S32, hal.HAL_OUT)
+        io.newpin('jog-speed', hal.HAL_FLOAT, hal.HAL_OUT)
+        io.newpin('jog-increment', hal.HAL_FLOAT, hal.HAL_OUT)
+        io.newpin('lead', hal.HAL_BIT, hal.HAL_OUT)
+        io.newpin('connected', hal.HAL_BIT, hal.HAL_OUT)
+        for pin in DISPLAY_PINS:
+            io.newpin(pin, hal.HAL_FLOAT, hal.HAL_IN)
+        io.newparam('jog-scale', hal.HAL_FLOAT, hal.HAL_RW)
+        io['jog-scale'] = 1.0
+        io.newparam('mpg-accel-threshold', hal.HAL_FLOAT, hal.HAL_RW)
+        io['mpg-accel-threshold'] = MPG_ACCEL_THRESHOLD
+        io.newparam('mpg-accel-range', hal.HAL_FLOAT, hal.HAL_RW)
+        io['mpg-accel-range'] = MPG_ACCEL_RANGE
+        io.newparam('mpg-accel-max', hal.HAL_FLOAT, hal.HAL_RW)
+        io['mpg-accel-max'] = MPG_ACCEL_MAX
+        self.io = io
+        self.values = {}  # the value last written to each pin
+
+        for pin in self.button_pins.values():
+            self.set(pin, False)
+        for pin in self.axis_pins.values():
+            self.set(pin, False)
+        self.set('mpg-count', 0)
+        self.set('mpg-accel-count', 0)
+        self.set('mpg-velocity', 0.0)
+        self.set('jog-velocity', 0.0)
+        self.set('axis-select', 0)
+        self.set('jog-speed', SPD_DEFAULT)
+        self.set('jog-increment', 0.0)
+        self.set('lead', False)
+        self.set('connected', False)
+        io.ready()
+
+    def set(self, pin, value):
+        if self.values.get(pin) != value:
+            self.io[pin] = value
+            self.values[pin] = value
+
+    def update(self, state):
+        """
+        :param state: PendantState, only the controls in state.changed are looked at
+        """
+        control_index = self.decoder.control_index
+        for name in state.changed:
+            if name == MPG_KEY:
+                self.set('mpg-count', wrap_s32(state.mpg_count))
+            elif name == AXIS_KEY:
+                axis = state.axis
+                self.set('axis-select', AXIS_SELECT.get(axis, 0))
+                for axis_name, pin in self.axis_pins.items():
+                    self.set(pin, axis == axis_name)
+            elif name == SPEED_KEY:
+                self.set('jog-speed', JOG_SPEED.get(state.speed, SPD_DEFAULT))
+                self.set('lead', state.speed == 'lead')
+            else:
+                self.set(self.button_pins[name], state.buttons[control_index[name]])
+
+    def update_mpg(self, mpg):
+        """
+        Called every loop, with or without a report. jog-increment follows jog-scale here, it can be changed at any
+        time.
+
+        :param mpg: MpgVelocity, its acceleration curve is taken from the mpg-accel-* parameters
+        """
+        io = self.io
+        self.set('jog-increment', self.values['jog-speed'] * io['jog-scale'])
+        mpg.threshold = io['mpg-accel-threshold']
+        mpg.range_ = io['mpg-accel-range']
+        mpg.max_scale = io['mpg-accel-max']
+        self.set('mpg-accel-count', wrap_s32(int(round(mpg.accel_count))))
+        self.set('mpg-velocity', mpg.velocity)
+        self.set('jog-velocity', mpg.velocity * mpg.scale(abs(mpg.velocity)) * self.values['jog-increment'])
+
+    def display_values(self):
+        """:return: the display.* pin values, in the order of PendantDisplay.update()"""
+        io = self.io
+        return [io[pin] or 0.0 for pin in DISPLAY_PINS]  # HalShim pins start out as None
+
+    def disconnected(self):
+        """release every button so nothing stays pressed while the pendant is gone"""
+        for pin in self.button_pins.values():
+            self.set(pin, False)
+        self.set('connected', False)
+
+
+class PendantFault(IOError):
+    """the pendant stopped working (unplugged, stalled endpoint, ...), reconnect to recover"""
+    pass
+
+
+class PendantReader(object):
+    """
+    Reads HID reports from the pendant and keeps count of how that goes. AsyncPendantReader and SyncPendantReader
+    provide read() and write_display().
+
+    reads      reports received
+    timeouts   reads that waited READ_TIMEOUT_SECONDS without a report, normal while the pendant is idle
+    dropped    reports lost because they arrived faster than they were decoded
+    faults     transfers that failed, every fault raises PendantFault
+    """
+    COUNTERS = ('reads', 'timeouts', 'dropped', 'faults')
+
+    def __init__(self):
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.reported_at = time.time()
+        self.reported_reads = 0
+        self.log = log
+        # set by open_reader()
+        self.key = None  # usb bus and address, claimed while the reader is open
+        self.serial = None
+        self.profile = None
+
+    def close(self):
+        release_pendant(self.key)
+
+    def report(self, now):
+        """log reads/s and the counters every REPORT_INTERVAL_SECONDS"""
+        if now - self.reported_at < REPORT_INTERVAL_SECONDS:
+            return
+        counters = self.counters
+        reads_sec = (counters['reads'] - self.reported_reads) / (now - self.reported_at)
+        self.log.info('reads/sec %.1f - reads: %d, timeouts: %d, dropped: %d, faults: %d', reads_sec, counters['reads'],
+                 counters['timeouts'], counters['dropped'], counters['faults'])
+        self.reported_at = now
+        self.reported_reads = counters['reads']
+
+
+class AsyncPendantReader(PendantReader):
+    """
+    Keeps TRANSFER_COUNT interrupt transfers submitted through libusb (python-libusb1). Completed transfers queue
+    their report and are resubmitted right away from the callback, read() runs the libusb event loop and hands over
+    the queued reports.
+    """
+
+    def __init__(self, context, handle, transfer_count=TRANSFER_COUNT):
+        PendantReader.__init__(self)
+        self.context = context
+        self.handle = handle
+        setting = next(handle.getDevice().iterSettings())
+        endpoint = next(iter(setting))
+        self.endpoint = endpoint.getAddress()
+        self.packet_size = endpoint.getMaxPacketSize()
+        self.reports = deque()
+        self.fault = None
+        self.transfers = []
+        for _ in range(transfer_count):
+            transfer = handle.getTransfer()
+            transfer.setInterrupt(self.endpoint, self.packet_size, callback=self._on_transfer, timeout=0)
+            transfer.submit()
+            self.transfers.append(transfer)
+
+    def _on_transfer(self, transfer):
+        # called from inside handleEventsTimeout(), on the thread that called read()
+        status = transfer.getStatus()
+        if status == usb1.TRANSFER_COMPLETED:
+            if len(self.reports) >= REPORT_QUEUE_SIZE:
+                self.reports.popleft()
+                self.counters['dropped'] += 1
+            self.reports.append((time.time(), transfer.getBuffer()[:transfer.getActualLength()]))
+        elif status == usb1.TRANSFER_OVERFLOW:
+            self.counters['dropped'] += 1  # the report didn't fit the buffer, it is lost but the pendant is fine
+        elif status == usb1.TRANSFER_CANCELLED:
+            return
+        else:
+            self.counters['faults'] += 1
+            self.fault = 'transfer failed, status: {}'.format(status)
+            return
+        transfer.submit()
+
+    def read(self, timeout=READ_TIMEOUT_SECONDS):
+        """
+        :param timeout: seconds to wait for a report
+        :return: list of (receive time, report) tuples, oldest first, empty on a timeout
+        """
+        if not self.reports and self.fault is None:
+            self.context.handleEventsTimeout(tv=timeout)
+        if self.fault is not None:
+            raise PendantFault(self.fault)
+        if not self.reports:
+            self.counters['timeouts'] += 1
+            return []
+        reports = list(self.reports)
+        self.reports.clear()
+        self.counters['reads'] += len(reports)
+        return reports
+
+    def write_display(self, chunk):
+        """send one display chunk (report id + DISPLAY_CHUNK_SIZE bytes) as a HID feature report"""
+        try:
+            self.handle.controlWrite(0x21, 0x09, 0x300 | DISPLAY_REPORT_ID, INTERFACE, bytes(chunk),
+                                     timeout=DISPLAY_TIMEOUT_MS)
+        except usb1.USBError as e:
+            self.counters['faults'] += 1
+            raise PendantFault('display write failed - {}'.format(e))
+
+    def close(self):
+        for transfer in self.transfers:
+            if transfer.isSubmitted():
+                try:
+                    transfer.cancel()
+                except usb1.USBError:
+                    pass  # completed (or the device went away) while we were cancelling
+        # cancelled transfers complete through the event loop, a device that is gone may never complete them
+        give_up = time.time() + RECONNECT_WAIT_SECONDS
+        while any(transfer.isSubmitted() for transfer in self.transfers) and time.time() < give_up:
+            self.context.handleEventsTimeout(tv=READ_TIMEOUT_SECONDS)
+        self.handle.close()
+        self.context.close()
+        PendantReader.close(self)
+
+
+class SyncPendantReader(PendantReader):
+    """
+    Falls back to pyusb's blocking reads, one report per read(). Reports that arrive while the loop is busy
+    decoding are buffered by the kernel only as far as the endpoint allows.
+    """
+
+    def __init__(self, device):
+        PendantReader.__init__(self)
+        device.set_configuration()
+        cfg = device.get_active_configuration()
+        interface = cfg[(INTERFACE, 0)]
+        self.device = device
+        self.endpoint = interface[0]
+
+    def read(self, timeout=READ_TIMEOUT_SECONDS):
+        """:return: a list with the one report read, empty on a timeout"""
+        data = get_data(self.device, self.endpoint, int(timeout * 1000))
+        if data is None:
+            self.counters['timeouts'] += 1
+            return []
+        self.counters['reads'] += 1
+        return [(time.time(), data)]
+
+    def write_display(self, chunk):
+        try:
+            self.device.ctrl_transfer(0x21, 0x09, 0x300 | DISPLAY_REPORT_ID, INTERFACE, bytes(chunk),
+                                      timeout=DISPLAY_TIMEOUT_MS)
+        except usb.core.USBError as e:
+            self.counters['faults'] += 1
+            raise PendantFault('display write failed - {}'.format(e))
+
+
+class ProfileCache(object):
+    """
+    The profile picked for each pendant, by usb serial number, kept in a json file so a known pendant is never
+    probed again. Shared by every PendantHost.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or join(PROFILE_CACHE_DIR, PROFILE_CACHE_NAME)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as fp:
+                self.profiles = json.load(fp)
+        except (IOError, ValueError):
+            self.profiles = {}
+
+    def get(self, serial):
+        """:return: the cached PendantProfile of a serial number, None if there is none"""
+        return PROFILES.get(self.profiles.get(serial))
+
+    def put(self, serial, profile):
+        with self.lock:
+            if self.profiles.get(serial) == profile.name:
+                return
+            self.profiles[serial] = profile.name
+            try:
+                if not os.path.isdir(dirname(self.path)):
+                    os.makedirs(dirname(self.path))
+                with open(self.path, 'w') as fp:
+                    json.dump(self.profiles, fp, indent=2, sort_keys=True)
+            except (IOError, OSError) as e:
+                log.warning('unable to save pendant profiles to %s - %s', self.path, e)
+
+
+PendantDevice = namedtuple('PendantDevice', ('key', 'serial', 'profile', 'device'))
+
+CLAIMED = set()  # PendantDevice.key of every pendant with an open reader
+CLAIM_LOCK = threading.Lock()
+
+
+def release_pendant(key):
+    with CLAIM_LOCK:
+        CLAIMED.discard(key)
+
+
+def profiles_for(vendor_id, product_id):
+    """:return: list of the profiles with these usb ids, in PROFILES order"""
+    return [profile for profile in PROFILES.values()
+            if profile.vendor_id == vendor_id and profile.product_id == product_id]
+
+
+def usb_string(getter):
+    """:return: the usb string descriptor read by `getter`, None if it can't be read"""
+    try:
+        return getter()
+    except Exception:
+        return None  # no permission to open the device, or it has no such string
+
+
+def select_profile(profiles, serial, product, cache):
+    """
+    Pick the profile of a pendant. The product string is only read when the usb ids match several profiles and
+    the serial number isn't cached.
+
+    :param profiles: the profiles matching the usb ids of the pendant
+    :param product: callable, reads the usb product string
+    :param cache: ProfileCache, the profile picked for a serial number is saved in it
+    """
+    if len(profiles) == 1:
+        return profiles[0]
+    profile = cache.get(serial) if serial else None
+    if profile in profiles:
+        return profile
+    product = product() or ''
+    profile = next((profile for profile in profiles if profile.product_match and profile.product_match in product),
+                   profiles[0])
+    if serial:
+        cache.put(serial, profile)
+    return profile
+
+
+def profiles_compatible(profile, other):
+    """
+    :return: True if a component created for `profile` can serve a pendant of `other`, the reports only differ in
+             the axis selector positions (WHB04B-4 and -6), the axes missing from `profile` read as off
+    """
+    ignored = dict(name=None, product_match=None, axs_map=None)
+    return profile._replace(**ignored) == other._replace(**ignored)
+
+
+MISMATCHED = set()  # (PendantDevice.key, profile name) of every pendant that was skipped, warned about once
+
+
+def find_pendants(cache, context=None):
+    """
+    :param cache: ProfileCache
+    :param context: usb1.USBContext to enumerate with, pyusb is used without one
+    :return: list of PendantDevice, one per connected pendant
+    """
+    found = []
+    if context is not None:
+        for device in context.getDeviceIterator(skip_on_error=True):
+            profiles = profiles_for(device.getVendorID(), device.getProductID())
+            if not profiles:
+                continue
+            serial = usb_string(device.getSerialNumber)
+            profile = select_profile(profiles, serial, lambda: usb_string(device.getProduct), cache)
+            found.append(PendantDevice((device.getBusNumber(), device.getDeviceAddress()), serial, profile, device))
+        return found
+
+    for device in usb.core.find(find_all=True, custom_match=lambda dev: profiles_for(dev.idVendor, dev.idProduct)):
+        serial = usb_string(lambda: device.serial_number)
+        profile = select_profile(profiles_for(device.idVendor, device.idProduct), serial,
+                                 lambda: usb_string(lambda: device.product), cache)
+        found.append(PendantDevice((device.bus, device.address), serial, profile, device))
+    return found
+
+
+def open_reader(cache=None, serial=None, profile=None, exclude=()):
+    """
+    :param cache: ProfileCache, the default one if None
+    :param serial: only open the pendant with this usb serial number
+    :param profile: only open pendants of this PendantProfile, or of a compatible one
+    :param exclude: serial numbers of pendants not to open, those bound to other prefixes
+    :return: a PendantReader for the first matching pendant that isn't open already, None if there is none
+    """
+    if usb1 is None and usb is None:
+        raise ImportError('neither "libusb1" nor "pyusb" is available, install with "python3 -m pip install libusb1"')
+    cache = cache or ProfileCache()
+    context = usb1.USBContext() if usb1 is not None else None
+    for pendant in find_pendants(cache, context):
+        if serial is not None and pendant.serial != serial or pendant.serial in exclude:
             continue
+        if profile is not None and not profiles_compatible(profile, pendant.profile):
+            if (pendant.key, profile.name) not in MISMATCHED:
+                MISMATCHED.add((pendant.key, profile.name))
+                log.warning('%s pendant %s is connected, but the pins were created for a %s pendant and cannot '
+                            'serve it. Restart pendant_io.py with the pendant plugged in to use it',
+                            pendant.profile.name, pendant.serial, profile.name)
+            continue
+        with CLAIM_LOCK:
+            if pendant.key in CLAIMED:
+                continue
+            CLAIMED.add(pendant.key)
+        try:
+            if context is not None:
+                handle = pendant.device.open()
+                handle.setAutoDetachKernelDriver(True)
+                handle.claimInterface(INTERFACE)
+                reader = AsyncPendantReader(context, handle)
+            else:
+                reader = SyncPendantReader(pendant.device)
+        except Exception:
+            release_pendant(pendant.key)
+            if context is not None:
+                context.close()
+            raise
+        reader.key, reader.serial, reader.profile = pendant.key, pendant.serial, pendant.profile
+        return reader
+
+    if context is not None:
+        context.close()
+    return None
+
+
+def startup_profile(cache, serial=None, exclude=(), taken=None):
+    """
+    :param exclude: serial numbers of pendants not to look at, those bound to other prefixes
+    :param taken: set of PendantDevice.key, the pendants given to prefixes created before, the one looked at is
+                  added
+    :return: the profile a hal prefix is created with: the cached profile of its serial number, or the profile of
+             the pendant it would connect to now, DEFAULT_PROFILE if there is neither
+    """
+    taken = set() if taken is None else taken
+    profile = cache.get(serial) if serial else None
+    if profile is not None:
+        return profile
+    if usb1 is None and usb is None:
+        return PROFILES[DEFAULT_PROFILE]
+    context = usb1.USBContext() if usb1 is not None else None
+    try:
+        for pendant in find_pendants(cache, context):
+            if pendant.key in taken or pendant.serial in exclude:
+                continue
+            if serial is None or pendant.serial == serial:
+                taken.add(pendant.key)
+                return pendant.profile
+    finally:
+        if context is not None:
+            context.close()
+    return PROFILES[DEFAULT_PROFILE]
+
+
+def is_pendant(udev_device):
+    """:return: True if a udev usb device is a pendant of any profile"""
+    ids = (udev_device.get('ID_VENDOR_ID'), udev_device.get('ID_MODEL_ID'))
+    return any(ids == ('{:04x}'.format(profile.vendor_id), '{:04x}'.format(profile.product_id))
+               for profile in PROFILES.values())
 
-        pendant.set_configuration()
-        cfg = pendant.get_active_configuration()
-        interface = cfg[(0,0)]
-        endpoint = interface[0]
 
-        mpg_count = 0
-        fn_mode = True
+def wait_for_pendant(hotplug, timeout=None):
+    """
+    Sleep until a pendant is plugged in. Without udev events this is a RECONNECT_WAIT_SECONDS pause.
+
+    :param hotplug: HotplugMonitor watching usb devices
+    :param timeout: seconds to wait at most, None waits for a hotplug event however long it takes
+    """
+    if not hotplug.available:
+        time.sleep(RECONNECT_WAIT_SECONDS)
+        return
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        remaining = None if deadline is None else max(0.0, deadline - time.time())
+        readable, _, _ = select.select([hotplug], [], [], remaining)
+        if not readable:
+            return
+        if any(is_pendant(udev_device) for udev_device in hotplug.events()):
+            return
+
+
+class PendantHost(object):
+    """
+    Serves one hal prefix: connects to a pendant of its profile (the one with its serial number, if bound), feeds
+    its reports into the component and waits for the next pendant when it goes away. Every host runs on its own
+    thread with its own hotplug monitor.
+    """
+
+    def __init__(self, component, serial=None, cache=None, exclude=()):
+        """
+        :param component: PendantComponent, created for the profile this host connects to
+        :param serial: usb serial number of the pendant, None for any pendant that isn't served yet
+        :param exclude: serial numbers bound to other hosts, never opened by this one
+        """
+        self.component = component
+        self.decoder = component.decoder
+        self.serial = serial
+        self.exclude = frozenset(exclude)
+        self.cache = cache or ProfileCache()
+        self.log = logging.getLogger(component.name)
+        self.log.setLevel(logging.INFO)
+        # the MPG counts are kept over reconnects, a jump in mpg-count would jog the machine
+        self.state = PendantState(decoder=self.decoder)
+        self.mpg = MpgVelocity()
+        self.hotplug = HotplugMonitor(subsystem='usb', device_type='usb_device', logger=log)
+
+    def run(self):
+        component, state, mpg, decode = self.component, self.state, self.mpg, self.decoder.decode
+        self.log.warning('searching for %s pendant%s', self.decoder.profile.name,
+                         '' if self.serial is None else ' ' + self.serial)
         while True:
             try:
-                data = get_data(device=pendant, endpoint=endpoint, timeout=100)
-                if data is None:
-                    continue
-                buttons = read_data(data, fn_mode, mpg_count)
+                reader = open_reader(self.cache, self.serial, self.decoder.profile, self.exclude)
             except Exception as e:
-                raise
-                print('read failure', e)
-                time.sleep(1)
-                break
+                # most likely still being set up by udev, or claimed by another process
+                self.log.warning('unable to open pendant - %s', e)
+                wait_for_pendant(self.hotplug, RECONNECT_WAIT_SECONDS)
+                continue
+            if reader is None:
+                # no cpu is used until udev reports a pendant
+                wait_for_pendant(self.hotplug)
+                continue
+            reader.log = self.log
+            self.log.warning('%s pendant connected, serial %s', reader.profile.name, reader.serial)
+            if reader.profile is not self.decoder.profile:
+                self.log.warning('the pins follow the %s profile, axes of the %s pendant outside it read as off',
+                                 self.decoder.profile.name, reader.profile.name)
+            component.set('connected', True)
+
+            state.reset()
+            mpg.reset()
+            display = PendantDisplay(reader)
+            try:
+                while True:
+                    for timestamp, data in reader.read():
+                        if decode(data, state):
+                            component.update(state)
+                        mpg.update(state.mpg_delta, timestamp)
+                    now = time.time()
+                    mpg.update(0, now)
+                    component.update_mpg(mpg)
+                    if now >= display.next_refresh:
+                        display.update(now, *component.display_values())
+                    reader.report(now)
+            except PendantFault as e:
+                self.log.warning('pendant fault, reconnecting - %s', e)
+            finally:
+                # safe values until the pendant is back: nothing pressed, the MPG standing still
+                component.disconnected()
+                mpg.reset()
+                component.update_mpg(mpg)
+                try:
+                    reader.close()
+                except Exception as e:
+                    self.log.debug('error closing pendant - %s', e)
 
-            mpg_count = buttons.get('mpg', mpg_count)
-            fn_mode = buttons.get('fn_mode', fn_mode)
 
-            for name in sorted(buttons):
-                print(name, buttons[name])
+def main(argv=None):
+    """
+    :param argv: program arguments, a hal prefix per pendant, optionally bound to a usb serial number:
+                 PREFIX[=SERIAL]. A single COMPONENT_NAME prefix without any.
+    :return: exit status, 1 if a PendantHost died, its pins would be stuck at their last values otherwise
+    """
+    try:
+        import hal
+    except ImportError:
+        # if HAL isn't available we will provide a simple shim
+        # so the program  can be verified.
+        log.warning('hal unavailable, providing shim layer for debugging')
+        hal = HalShim
 
+    bindings = [arg.partition('=') for arg in (argv or [])[1:]] or [(COMPONENT_NAME, '', '')]
+    prefixes = [prefix for prefix, _, _ in bindings]
+    if len(set(prefixes)) != len(prefixes):
+        raise ValueError('every pendant needs its own prefix: {}'.format(' '.join(prefixes)))
 
-def get_data(device, endpoint, timeout=500):
+    cache = ProfileCache()
+    bound = set(serial for _, _, serial in bindings if serial)
+    taken = set()
+    hosts = []
+    for prefix, _, serial in sorted(bindings, key=lambda binding: not binding[2]):  # bound prefixes pick first
+        serial = serial or None
+        exclude = () if serial else bound
+        profile = startup_profile(cache, serial, exclude, taken)
+        log.warning('%s: %s profile', prefix, profile.name)
+        hosts.append(PendantHost(PendantComponent(hal, prefix, DECODERS[profile.name]), serial, cache, exclude))
+
+    threads = []
+    for host in hosts:
+        thread = threading.Thread(target=host.run, name=host.component.name)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    while True:
+        time.sleep(HOST_CHECK_SECONDS)
+        for thread in threads:
+            if not thread.is_alive():
+                log.critical('%s: pendant host is gone, exiting', thread.name)
+                return 1
 
+
+def get_data(device, endpoint, timeout=500):
+    """
+    :return: the report read from the device, None on a timeout. Any other USB error raises PendantFault.
+    """
     try:
         data = device.read(endpoint.bEndpointAddress, endpoint.wMaxPacketSize, timeout=timeout)
     except usb.core.USBError as e:
-        return None
+        if e.errno == errno.ETIMEDOUT or getattr(e, 'backend_error_code', None) == LIBUSB_ERROR_TIMEOUT:
+            return None
+        raise PendantFault(str(e))
 
     return data
 
 
+class PendantState(object):
+    """
+    The state of every pendant control, updated in place by PendantDecoder.decode().
+
+    buttons     list of bools, by button index (see PendantDecoder.controls)
+    axis        AXS_MAP name of the axis selector position (the raw code if it isn't in the map)
+    speed       SPD_MAP name of the speed selector position (the raw code if it isn't in the map)
+    mpg_count   accumulated MPG counts
+    mpg_delta   MPG counts in the most recent report
+    fn_mode     the function button was held in the previous report, selects BTN_MAP over MACRO_MAP
+    release     no button is pressed
+    changed     names of the controls that changed in the most recent report (button names, AXIS_KEY, SPEED_KEY,
+                MPG_KEY), the list is reused for every report
+    """
+    __slots__ = ('buttons', 'pressed', 'axis_code', 'axis', 'speed_code', 'speed', 'mpg_count', 'mpg_delta',
+                 'fn_mode', 'release', 'changed', 'decoder')
+
+    def __init__(self, fn_mode=True, mpg_count=0, decoder=None):
+        """
+        :param decoder: PendantDecoder the state is decoded with, sizes the button list
+        """
+        self.decoder = decoder or DEFAULT_DECODER
+        self.buttons = [False] * len(self.decoder.controls)
+        self.pressed = [None, None]  # button index of each of the two button bytes
+        self.axis_code = self.speed_code = None
+        self.axis = self.speed = None
+        self.mpg_count = mpg_count
+        self.mpg_delta = 0
+        self.fn_mode = fn_mode
+        self.release = True
+        self.changed = []
+
+    def reset(self):
+        """forget the buttons and selectors (the pendant went away), the MPG count is kept"""
+        self.__init__(mpg_count=self.mpg_count, decoder=self.decoder)
+
+    def as_dict(self):
+        """:return: the state in the format read_data() returns"""
+        state = dict(zip(self.decoder.controls, self.buttons))
+        state[AXIS_KEY] = self.axis
+        state[SPEED_KEY] = self.speed
+        state[MPG_KEY] = self.mpg_count
+        state['release'] = self.release
+        return state
+
+
+class PendantDecoder(object):
+    """
+    Decodes the reports of one profile. The lookup tables are built once per profile, decode() applies a report to
+    a PendantState without building anything per report.
+
+    controls        every button name of the profile, by button index
+    control_index   button name -> button index
+    axes            the AXIS_SELECT axes on the selector of the profile
+    table           table[fn_mode][button code] is the button index, None for unused codes
+    """
+
+    def __init__(self, profile):
+        self.profile = profile
+        # copied from the profile, attributes of the decoder are quicker to look up per report
+        self.btn_byte, self.btn2_byte = profile.btn_byte, profile.btn2_byte
+        self.axs_byte, self.spd_byte, self.enc_byte = profile.axs_byte, profile.spd_byte, profile.enc_byte
+        self.axs_map, self.spd_map = profile.axs_map, profile.spd_map
+        self.controls = tuple(sorted(set(profile.btn_map.values()) | set(profile.macro_map.values())))
+        self.control_index = dict((name, idx) for idx, name in enumerate(self.controls))
+        self.fn_index = self.control_index.get('fn_mode')  # None without a function button
+        self.axes = tuple(sorted((axis for axis in set(profile.axs_map.values())
+                                  if axis in AXIS_SELECT and axis != 'off'), key=AXIS_SELECT.get))
+        tables = []
+        for code_map in (profile.macro_map, profile.btn_map):  # indexed by fn_mode, False then True
+            table = [None] * 256
+            for code, name in code_map.items():
+                table[code] = self.control_index[name]
+            tables.append(table)
+        self.table = tuple(tables)
+
+    def decode(self, data, state):
+        """
+        :param data: raw data read from the device
+        :param state: PendantState, updated in place
+        :return: state.changed, the names of the controls that changed
+
+        The buttons of a report are mapped with the function button state of the previous report, like read_data()
+        called in a loop. An MPG-only report (nothing pressed) leaves the function mode off:
+
+        >>> state = PendantState()
+        >>> report = bytearray((0x04, 0, 0, 0, 0, 17, 13, 0))
+        >>> _ = decode_report(report, state)
+        >>> report[BTN_BYTE], report[ENC_BYTE] = 4, 0
+        >>> [name for name in decode_report(report, state) if state.buttons[DEFAULT_DECODER.control_index[name]]]
+        ['macro1']
+        """
+        changed = state.changed
+        del changed[:]
+
+        # two buttons can be pressed at the same time
+        table = self.table[state.fn_mode]
+        first = table[data[self.btn_byte]]
+        second = table[data[self.btn2_byte]]
+        pressed = state.pressed
+        if first != pressed[0] or second != pressed[1]:
+            buttons = state.buttons
+            controls = self.controls
+            for idx in pressed:
+                if idx is not None and idx != first and idx != second:
+                    buttons[idx] = False
+                    changed.append(controls[idx])
+            pressed[0] = first
+            pressed[1] = second
+            for idx in pressed:
+                if idx is not None and not buttons[idx]:
+                    buttons[idx] = True
+                    changed.append(controls[idx])
+        if self.fn_index is not None:
+            # every report, the table of the next report follows whether the function button is held in this one
+            state.fn_mode = state.buttons[self.fn_index]
+        state.release = data[self.btn_byte] == 0
+
+        code = data[self.axs_byte]
+        if code != state.axis_code:
+            state.axis_code = code
+            state.axis = self.axs_map.get(code, code)
+            changed.append(AXIS_KEY)
+
+        if self.spd_byte is not None:
+            code = data[self.spd_byte]
+            if code != state.speed_code:
+                state.speed_code = code
+                state.speed = self.spd_map.get(code, code)
+                changed.append(SPEED_KEY)
+
+        mpg_val = data[self.enc_byte]
+        if mpg_val:
+            state.mpg_delta = mpg_val - 256 if mpg_val > 127 else mpg_val
+            state.mpg_count += state.mpg_delta
+            changed.append(MPG_KEY)
+        else:
+            state.mpg_delta = 0
+        return changed
+
+
+DECODERS = dict((name, PendantDecoder(profile)) for name, profile in PROFILES.items())
+DEFAULT_DECODER = DECODERS[DEFAULT_PROFILE]
+decode_report = DEFAULT_DECODER.decode  # decode_report(data, state), reports of the default profile
+
+
 def read_data(data, fn_mode=False, mpg_count=0):
     """
-    Returns the sate of all buttons as a dictionary
+    Returns the sate of all buttons as a dictionary, the driver itself uses PendantDecoder.decode()
 
     :param data: raw data read from the device
     :param fn_mode: True/False the state of the toggle 'function-mode' determines if a macro is returned or a regular button
     :param mpg_count: If you would like the MPG count to be added to or removed from include this
     :return:
     """
-    btns = {key: False for key in (list(BTN_MAP.values()) + list(MACRO_MAP.values()))}
+    state = PendantState(fn_mode, mpg_count)
+    decode_report(data, state)
+    return state.as_dict()
 
-    axs = AXS_MAP.get(data[AXS_BYTE], data[AXS_BYTE])
-    btns[AXIS_KEY] = axs
 
-    spd = SPD_MAP.get(data[SPD_BYTE], data[SPD_BYTE])
-    btns[SPEED_KEY] = spd
+class MpgVelocity(object):
+    """
+    Estimates the MPG wheel velocity from timestamped counts, and scales counts with an acceleration curve so fast
+    spins cover long distances while slow turns keep moving one jog increment per count.
 
-    # two buttons can be pressed at the same time
-    btn_code = data[BTN_BYTE]
-    btn2_code = data[BTN2_BYTE]
-    active_btns = set((btn_code, btn2_code))
+    The multiplier is 1.0 up to `threshold` counts/s and rises quadratically to `max_scale` at
+    `threshold + range_` counts/s.
+    """
 
-    if fn_mode:
-        for code, btn_name in BTN_MAP.items():
-            btns[btn_name] = code in active_btns
+    def __init__(self, samples=MPG_SAMPLES, window=MPG_WINDOW_SECONDS):
+        self.times = [0.0] * samples  # ring buffer of report times, newest at `head`
+        self.deltas = [0] * samples
+        self.head = 0
+        self.window = window
+        self.threshold = MPG_ACCEL_THRESHOLD
+        self.range_ = MPG_ACCEL_RANGE
+        self.max_scale = MPG_ACCEL_MAX
+        self.velocity = 0.0  # smoothed, counts/s
+        self.updated = None  # time of the previous update
+        self.accel_count = 0.0  # counts scaled by the acceleration curve
 
-    else:
-        for code, btn_name in MACRO_MAP.items():
-            btns[btn_name] = code in active_btns
+    def reset(self):
+        """the wheel stopped (the pendant went away), the scaled count is kept"""
+        self.times = [0.0] * len(self.times)
+        self.deltas = [0] * len(self.deltas)
+        self.velocity = 0.0
+        self.updated = None
 
-    mpg_val = data[ENC_BYTE]
-    if mpg_val > 127:
-        mpg_count = mpg_count + (256 - mpg_val) * -1
-    else:
-        mpg_count = mpg_count + mpg_val
+    def scale(self, speed):
+        """
+        :param speed: wheel velocity, counts/s (unsigned)
+        :return: the multiplier for counts at this velocity
+        """
+        if speed <= self.threshold or self.range_ <= 0:
+            return 1.0
+        fraction = min(1.0, (speed - self.threshold) / self.range_)
+        return 1.0 + (self.max_scale - 1.0) * fraction * fraction
 
-    btns[MPG_KEY] = mpg_count
-    btns['release'] = btn_code == 0
-    return btns
+    def update(self, delta, now):
+        """
+        Add the counts of a report, also called with 0 while no reports arrive so the velocity decays
 
+        :param delta: MPG counts of the report (signed)
+        :param now: time of the report, seconds
+        :return: the smoothed velocity, counts/s
+        """
+        times = self.times
+        deltas = self.deltas
+        if delta:
+            self.head = (self.head + 1) % len(times)
+            times[self.head] = now
+            deltas[self.head] = delta
 
-class Whb04b_struct(ctypes.Structure):
-    buff_old = 'buff_old'
-    _fields_ = [
-                   #/* header of our packet */
-                   ("header", ctypes.c_uint16, ),
-                   ("seed", ctypes.c_uint8),
-                   ("flags", ctypes.c_uint8),
-                   #/* work pos */
-                   ("x_wc_int", ctypes.c_uint16),
-                   ("x_wc_frac", ctypes.c_uint16),
-                   ("y_wc_int", ctypes.c_uint16),
-                   ("y_wc_frac", ctypes.c_uint16),
-                   ("z_wc_int", ctypes.c_uint16),
-                   ("z_wc_frac", ctypes.c_uint16),
-                   #/* speed */
-                   ("feedrate", ctypes.c_uint16),
-                   ("sspeed", ctypes.c_uint16),
-                   ("padding", ctypes.c_uint8 * 8) ]
+        counts = 0
+        since = now - self.window
+        idx = self.head
+        for _ in range(len(times)):
+            if times[idx] <= since:
+                break
+            counts += deltas[idx]
+            idx -= 1  # negative indexes wrap around the ring
+        if self.updated is None or now - self.updated > 0:
+            # reports arrive irregularly, the smoothing weight follows the time since the previous update
+            weight = 1.0 if self.updated is None else 1.0 - math.exp((self.updated - now) / MPG_SMOOTHING_SECONDS)
+            self.velocity += (counts / self.window - self.velocity) * weight
+            self.updated = now
+
+        if delta:
+            self.accel_count += delta * self.scale(abs(self.velocity))
+        return self.velocity
 
 
-def update_display(device):
+class Whb04b_struct(ctypes.Structure):
     """
+    The display packet, sent as DISPLAY_CHUNKS feature reports of DISPLAY_CHUNK_SIZE bytes.
+
+    Positions are sent as an integer part and a fraction in 1/10000, bit 15 of the fraction is the sign.
+
 struct whb03_out_data
 {
    /* header of our packet */
@@ -218,42 +1144,91 @@ struct whb03_out_data
    uint8_t    state;
 
 };
-    :param x:
-    :param y:
-    :param z:
-    :return:
     """
-    p = Whb04b_struct()
-    data = None
-    showRotary = False
-    data_old = 0
-    pendant_is_on = False
-
-    p.header = 0xFDFE
-    p.seed = 0xFE
-    p.flags = 0x01
-    p.x_wc_int = 100
-    p.x_wc_frace = 2000
-    p.y_wc_int = 200
-    p.y_wc_frace = 1000
-    p.z_wc_int = 300
-    p.z_wc_frace = 3000
-    p.feedrate = 16
-    p.sspeed = 3600
-
-    buff = ctypes.cast(ctypes.byref(p), ctypes.POINTER(ctypes.c_char * ctypes.sizeof(p)))
-    if buff.contents.raw != p.buff_old and pendant_is_on:
-        # print " ".join(hex(ord(c)) for c in buff.contents.raw)
-        device.ctrl_transfer(0x21, 0x09, 0x306, 0x00, chr(0x06) + buff.contents.raw[0:7])
-        device.ctrl_transfer(0x21, 0x09, 0x306, 0x00, chr(0x06) + buff.contents.raw[7:14])
-        device.ctrl_transfer(0x21, 0x09, 0x306, 0x00, chr(0x06) + buff.contents.raw[14:21])
-        # dev.ctrl_transfer(0x21, 0x09, 0x306, 0x00, chr(0x06) + buff.contents.raw[21:28])
-        # dev.ctrl_transfer(0x21, 0x09, 0x306, 0x00, chr(0x06) + buff.contents.raw[28:35])
-        p.buff_old = buff.contents.raw
-
-
-def find_device():
-    return usb.core.find(idProduct=PRODUCT_ID)
+    _fields_ = [
+                   #/* header of our packet */
+                   ("header", ctypes.c_uint16, ),
+                   ("seed", ctypes.c_uint8),
+                   ("flags", ctypes.c_uint8),
+                   #/* work pos */
+                   ("x_wc_int", ctypes.c_uint16),
+                   ("x_wc_frac", ctypes.c_uint16),
+                   ("y_wc_int", ctypes.c_uint16),
+                   ("y_wc_frac", ctypes.c_uint16),
+                   ("z_wc_int", ctypes.c_uint16),
+                   ("z_wc_frac", ctypes.c_uint16),
+                   #/* speed */
+                   ("feedrate", ctypes.c_uint16),
+                   ("sspeed", ctypes.c_uint16),
+                   ("padding", ctypes.c_uint8 * 8) ]
+
+
+def split_position(value):
+    """
+    :return: (integer part, fraction) of a position in the display format
+    """
+    magnitude = abs(value)
+    integer = int(magnitude)
+    fraction = int(round((magnitude - integer) * 10000))
+    if fraction >= 10000:
+        integer += 1
+        fraction -= 10000
+    if value < 0:
+        fraction |= 0x8000
+    return min(integer, 0xFFFF), fraction
+
+
+class PendantDisplay(object):
+    """
+    Encodes live values into the display packet and sends the DISPLAY_CHUNK_SIZE chunks that changed, at most
+    every DISPLAY_REFRESH_SECONDS, so display traffic never crowds out the jog reports.
+    """
+
+    def __init__(self, reader, refresh_seconds=DISPLAY_REFRESH_SECONDS):
+        """
+        :param reader: the PendantReader of the connected pendant, its write_display() sends a chunk
+        """
+        self.reader = reader
+        self.refresh_seconds = refresh_seconds
+        self.packet = Whb04b_struct()
+        self.packet.header = 0xFDFE
+        self.packet.seed = 0xFE
+        self.packet.flags = 0x01
+        self.sent = [None] * DISPLAY_CHUNKS  # the chunks the pendant is showing, None until sent once
+        self.next_refresh = 0.0
+        self.chunks_sent = 0
+
+    def update(self, now, x, y, z, feedrate, spindle_speed):
+        """
+        :param now: current time, nothing is sent before the next refresh is due
+        :return: the number of chunks sent
+        """
+        if now < self.next_refresh:
+            return 0
+        self.next_refresh = now + self.refresh_seconds
+
+        packet = self.packet
+        packet.x_wc_int, packet.x_wc_frac = split_position(x)
+        packet.y_wc_int, packet.y_wc_frac = split_position(y)
+        packet.z_wc_int, packet.z_wc_frac = split_position(z)
+        packet.feedrate = min(max(int(round(feedrate)), 0), 0xFFFF)
+        packet.sspeed = min(max(int(round(spindle_speed)), 0), 0xFFFF)
+
+        raw = ctypes.string_at(ctypes.addressof(packet), ctypes.sizeof(packet))
+        sent = 0
+        for idx in range(DISPLAY_CHUNKS):
+            chunk = raw[idx * DISPLAY_CHUNK_SIZE:(idx + 1) * DISPLAY_CHUNK_SIZE]
+            if chunk != self.sent[idx]:
+                self.reader.write_display(bytearray((DISPLAY_REPORT_ID,)) + chunk)
+                self.sent[idx] = chunk
+                sent += 1
+        self.chunks_sent += sent
+        return sent
+
+
+def find_device(profile=None):
+    profile = profile or PROFILES[DEFAULT_PROFILE]
+    return usb.core.find(idVendor=profile.vendor_id, idProduct=profile.product_id)
 
 
 if __name__ == '__main__':